@@ -0,0 +1,217 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import argparse
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import utilities
+from utilities import get_file_paths, get_pixel_width, km_to_pixel, INPUT_PROJECTION
+from image_loader import get_image, get_neighbours, reproject_image, set_tile_catalog
+from catalog import get_catalog
+from patch_extractor import PatchExtractor, to_output
+from labels_writer import LabelsWriter, label_to_line, COLUMNS
+from sample_writer import encode_patch, CODECS
+from sampler import get_sample_points, get_tile_prefix, get_tile_random
+from source_sampler import get_source_image, SourceExtractor
+
+#One tile per latitude band of get_pixel_width (3600, 1800, 1200 and 600 pixels wide) and the equator
+LATITUDES = [0, 47, 65, 75, 84]
+LONGITUDE = 10
+
+STAGES = ['reprojection', 'mosaic', 'points', 'extraction', 'direct', 'encoding', 'labels']
+
+NODATA = -9999
+
+def generate_tile(path, latitude, longitude, seed=0, nodata_fraction=0.0):
+    #Synthetic ALOS DSM tile: int16 heights in WGS84 with the pixel width of the latitude band
+    width = get_pixel_width(latitude)
+    height = utilities.IMAGE_HEIGHT
+
+    rng = np.random.RandomState((seed * 64800 + (latitude + 90) * 360 + (longitude + 180)) % 2**32)
+
+    #Smooth terrain from a few random waves plus some noise
+    y = np.linspace(latitude + 1, latitude, height, dtype=np.float32)[:, None]
+    x = np.linspace(longitude, longitude + 1, width, dtype=np.float32)[None, :]
+
+    data = np.full((height, width), 1000.0, np.float32)
+    for _ in range(4):
+        frequency, phase, amplitude = rng.uniform(2, 20), rng.uniform(0, 2*np.pi), rng.uniform(100, 800)
+        direction = rng.uniform(0, np.pi)
+        data += amplitude * np.sin(frequency * (np.cos(direction) * x + np.sin(direction) * y) + phase)
+    data += rng.normal(0, 5, data.shape).astype(np.float32)
+    data = data.astype(np.int16)
+
+    if nodata_fraction > 0: data[rng.rand(height, width) < nodata_fraction] = NODATA
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 1, 'dtype': 'int16', 'nodata': NODATA,
+        'crs': INPUT_PROJECTION, 'transform': from_origin(longitude, latitude + 1, 1.0 / width, 1.0 / height)}
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+def generate_neighbourhood(root, latitude, longitude, seed=0, nodata_fraction=0.0):
+    #3x3 tiles around latitude, longitude, existing tiles are kept
+    lats, lons = get_neighbours(latitude, longitude)
+
+    for lat in lats:
+        if lat is None: continue
+        for lon in lons:
+            file_name, folder_name = get_file_paths(lat, lon)
+            path = os.path.join(root, folder_name, file_name)
+
+            if not os.path.exists(path): generate_tile(path, lat, lon, seed, nodata_fraction)
+
+def measure(function, repeats):
+    #Returns the timings of all runs and the result of the last run
+    timings = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - start)
+
+    return {'min': min(timings), 'mean': sum(timings) / len(timings), 'runs': timings}, result
+
+def benchmark_tile(root, latitude, longitude, edge_length, amount_samples, output_size, bit_depth=8, repeats=3, seed=0, codec='png', compress_level=None):
+    file_name, folder_name = get_file_paths(latitude, longitude)
+    path = os.path.join(root, folder_name, file_name)
+
+    edge_length_pixel = km_to_pixel(latitude, longitude, edge_length)
+
+    stages = {}
+
+    stages['reprojection'], _ = measure(lambda: reproject_image(path), repeats)
+
+    stages['mosaic'], result = measure(lambda: get_image(root, latitude, longitude, edge_length_pixel, bit_depth), repeats)
+    image, min_height, max_height, placeholders = result
+
+    def get_points():
+        tile_random = get_tile_random(latitude, longitude, seed)
+        return get_sample_points(latitude, longitude, image.shape, placeholders, amount_samples, edge_length, edge_length_pixel, tile_random=tile_random)
+
+    stages['points'], (points_pixel, points_lat_lon, angles) = measure(get_points, repeats)
+
+    def extract():
+        extractor = PatchExtractor(image, edge_length_pixel, output_size)
+        return [to_output(patch, bit_depth) for patch in extractor.iter_patches(points_pixel, angles)]
+
+    stages['extraction'], patches = measure(extract, repeats)
+
+    #Mosaic and extraction of the direct engine, which reads the samples from the source tiles
+    def extract_direct():
+        source_image = get_source_image(root, latitude, longitude, edge_length_pixel, bit_depth)[0]
+        extractor = SourceExtractor(source_image, edge_length_pixel, output_size)
+        return [to_output(patch, bit_depth) for patch in extractor.iter_patches(points_pixel, angles)]
+
+    stages['direct'], _ = measure(extract_direct, repeats)
+
+    stages['encoding'], encoded = measure(lambda: [encode_patch(patch, codec, compress_level) for patch in patches], repeats)
+
+    file_prefix = get_tile_prefix((latitude, longitude))
+    labels = [dict(zip(COLUMNS, (os.path.join(file_prefix, file_prefix + '_' + str(point_id) + '.png'), lat_lon[0], lat_lon[1], angle, min_height, max_height)))
+        for point_id, (lat_lon, angle) in enumerate(zip(points_lat_lon, angles))]
+
+    with tempfile.TemporaryDirectory() as labels_dir:
+        def write_labels():
+            with LabelsWriter(os.path.join(labels_dir, 'labels.csv'), 'w') as writer:
+                writer.write_lines([label_to_line(label) for label in labels])
+
+        stages['labels'], _ = measure(write_labels, repeats)
+
+    return {'latitude': latitude, 'longitude': longitude, 'pixel_width': get_pixel_width(latitude), 'edge_length_pixel': edge_length_pixel,
+        'mosaic_shape': list(image.shape), 'samples': len(patches), 'encoded_bytes': sum(len(data) for data in encoded), 'stages': stages}
+
+def get_revision():
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    except OSError:
+        return None
+
+    return output.stdout.strip() or None
+
+def run_benchmark(data_dir, latitudes=LATITUDES, longitude=LONGITUDE, edge_length=10, amount_samples=100, output_size=256, bit_depth=8, repeats=3, seed=0, nodata_fraction=0.0, codec='png', compress_level=None):
+
+    for latitude in latitudes:
+        print('Generate tiles around {} {}'.format(latitude, longitude))
+        generate_neighbourhood(data_dir, latitude, longitude, seed, nodata_fraction)
+
+    #Like the sampler, tiles and their height statistics are looked up in the catalog
+    set_tile_catalog(get_catalog(data_dir))
+
+    results = []
+    for latitude in latitudes:
+        print('Benchmark {} {}'.format(latitude, longitude))
+        results.append(benchmark_tile(data_dir, latitude, longitude, edge_length, amount_samples, output_size, bit_depth, repeats, seed, codec, compress_level))
+
+    parameters = {'edge_length': edge_length, 'amount_samples': amount_samples, 'output_size': output_size, 'bit_depth': bit_depth,
+        'repeats': repeats, 'seed': seed, 'nodata_fraction': nodata_fraction, 'codec': codec, 'compress_level': compress_level}
+
+    environment = {'python': platform.python_version(), 'numpy': np.__version__, 'rasterio': rasterio.__version__,
+        'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+    return {'revision': get_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'parameters': parameters, 'environment': environment, 'results': results}
+
+def print_results(report, baseline=None):
+    #Best time of every stage in ms, with the ratio to the baseline if one is given
+    baseline_results = {}
+    if baseline is not None: baseline_results = {(result['latitude'], result['longitude']): result for result in baseline['results']}
+
+    print('{:>8} {:>6} '.format('Latitude', 'Width') + ' '.join('{:>14}'.format(stage) for stage in STAGES))
+
+    for result in report['results']:
+        previous = baseline_results.get((result['latitude'], result['longitude']))
+
+        columns = []
+        for stage in STAGES:
+            best = result['stages'][stage]['min']
+            column = '{:.1f}'.format(best * 1000)
+            if previous is not None and previous['stages'].get(stage, {}).get('min', 0) > 0: column += ' x{:.2f}'.format(best / previous['stages'][stage]['min'])
+            columns.append('{:>14}'.format(column))
+
+        print('{:>8} {:>6} '.format(result['latitude'], result['pixel_width']) + ' '.join(columns))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark every stage of the sampler on synthetic tiles')
+    parser.add_argument("-o", "--output", help="json file of the results", default='benchmark.json', type=str)
+    parser.add_argument("--data-dir", help="directory of the synthetic tiles, generated tiles are reused (default: temporary directory)", default=None, type=str)
+    parser.add_argument("--latitudes", help="latitudes of the benchmarked tiles", default=LATITUDES, type=int, nargs='+')
+    parser.add_argument("--longitude", help="longitude of the benchmarked tiles", default=LONGITUDE, type=int)
+    parser.add_argument("--edge-length", help="edge length of the samples in km", default=10, type=float)
+    parser.add_argument("--samples", help="samples per tile", default=100, type=int)
+    parser.add_argument("-s", "--size", help="output size of the samples in pixels", default=256, type=int)
+    parser.add_argument("--bit-depth", help="bit depth of the samples", default=8, type=int, choices=[8, 16])
+    parser.add_argument("--codec", help="codec of the encoding stage", default='png', choices=CODECS)
+    parser.add_argument("--compress-level", help="zlib compression level of png samples", default=None, type=int, choices=range(10))
+    parser.add_argument("--repeats", help="runs of every stage, the best and the mean time are reported", default=3, type=int)
+    parser.add_argument("--seed", help="seed of the synthetic tiles and sample positions", default=0, type=int)
+    parser.add_argument("--nodata", help="fraction of nodata pixels in the synthetic tiles", default=0.0, type=float)
+    parser.add_argument("--baseline", help="json file of an earlier benchmark to compare with", default=None, type=str)
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        data_dir = args.data_dir
+        if data_dir is None: data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        report = run_benchmark(data_dir, args.latitudes, args.longitude, args.edge_length, args.samples, args.size, args.bit_depth, args.repeats, args.seed, args.nodata, args.codec, args.compress_level)
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    print_results(report, baseline)
+    print('Results written to ' + args.output)
@@ -0,0 +1,258 @@
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+import rasterio
+
+from utilities import string_to_position
+
+CATALOG_NAME = 'catalog.json'
+CATALOG_VERSION = 2
+
+STATS_FIELDS = ['nodata_fraction', 'min_height', 'max_height', 'mean_height', 'edge_min', 'edge_max']
+FIELDS = ['path', 'latitude', 'longitude', 'size', 'mtime'] + STATS_FIELDS
+
+#Edge profiles: height range of the bands along the edges of a tile which are 1/EDGE_DIVISIONS ... EDGE_STEPS/EDGE_DIVISIONS
+#of the tile deep and of the rectangles in its corners which are as many rows deep and as many columns wide (squares) or
+#get_corner_aspect times as many columns wide (wide, the shape of the corners of the mosaic margin), EDGE_STEPS values
+#per side and corner.
+EDGE_SIDES = ['top', 'bottom', 'left', 'right']
+EDGE_CORNERS = ['top_left', 'top_right', 'bottom_left', 'bottom_right']
+EDGE_PROFILES = EDGE_SIDES + EDGE_CORNERS + [corner + '_wide' for corner in EDGE_CORNERS]
+EDGE_DIVISIONS = 64
+EDGE_STEPS = 64
+
+def is_tile_file(file):
+    return file.endswith("DSM.tif") and not file.startswith(".")
+
+def get_corner_aspect(latitude):
+    #Degrees of longitude per degree of latitude of the same distance at latitude
+    return 1.0 / max(math.cos(math.radians(latitude)), 1e-6)
+
+def get_edge_depths(size, aspect=1.0):
+    #Pixels of the bands of the edge profiles
+    return np.array([min(max(int(math.ceil(size * aspect * (step + 1) / float(EDGE_DIVISIONS))), 1), size) for step in range(EDGE_STEPS)])
+
+def get_block_starts(size, depths):
+    #Starts of the blocks between the borders of the bands from both ends, each band is a run of whole blocks
+    depths = np.concatenate(depths)
+    starts = np.unique(np.concatenate([[0], depths, size - depths]))
+    return starts[starts < size]
+
+def get_edge_profiles(data, top_latitude, bottom_latitude):
+    #Minima and maxima of the bands and corners of EDGE_PROFILES, nodata pixels are filled with 0 like in the mosaic
+    height, width = data.shape
+    row_depths, col_depths = get_edge_depths(height), get_edge_depths(width)
+    top_wide_depths, bottom_wide_depths = get_edge_depths(width, get_corner_aspect(top_latitude)), get_edge_depths(width, get_corner_aspect(bottom_latitude))
+
+    row_starts = get_block_starts(height, [row_depths])
+    col_starts = get_block_starts(width, [col_depths, top_wide_depths, bottom_wide_depths])
+
+    block_min = np.minimum.reduceat(np.minimum.reduceat(data, row_starts, axis=0), col_starts, axis=1)
+    block_max = np.maximum.reduceat(np.maximum.reduceat(data, row_starts, axis=0), col_starts, axis=1)
+
+    #Number of blocks in the bands from the top or left and from the bottom or right
+    def from_start(starts, depths): return np.searchsorted(starts, depths)
+    def from_stop(starts, size, depths): return len(starts) - np.searchsorted(starts, size - depths)
+
+    top, bottom = from_start(row_starts, row_depths), from_stop(row_starts, height, row_depths)
+    left, right = from_start(col_starts, col_depths), from_stop(col_starts, width, col_depths)
+
+    profiles = []
+    for side_min, side_max, blocks in [(block_min.min(axis=1), block_max.max(axis=1), top), (block_min.min(axis=1)[::-1], block_max.max(axis=1)[::-1], bottom),
+            (block_min.min(axis=0), block_max.max(axis=0), left), (block_min.min(axis=0)[::-1], block_max.max(axis=0)[::-1], right)]:
+        profiles.append((np.minimum.accumulate(side_min)[blocks - 1], np.maximum.accumulate(side_max)[blocks - 1]))
+
+    #Every corner is moved to the top left, the cumulative minimum over both axes is the one of the rectangle
+    corners = []
+    for row_step, rows, wide_depths in [(1, top, top_wide_depths), (-1, bottom, bottom_wide_depths)]:
+        for col_step, cols, wide_cols in [(1, left, from_start(col_starts, wide_depths)), (-1, right, from_stop(col_starts, width, wide_depths))]:
+            corner_min = np.minimum.accumulate(np.minimum.accumulate(block_min[::row_step, ::col_step], axis=0), axis=1)
+            corner_max = np.maximum.accumulate(np.maximum.accumulate(block_max[::row_step, ::col_step], axis=0), axis=1)
+            profiles.append((corner_min[rows - 1, cols - 1], corner_max[rows - 1, cols - 1]))
+            corners.append((corner_min[rows - 1, wide_cols - 1], corner_max[rows - 1, wide_cols - 1]))
+    profiles += corners
+
+    #Integer heights stay integers in the json
+    return np.concatenate([low for low, _ in profiles]).tolist(), np.concatenate([high for _, high in profiles]).tolist()
+
+def get_tile_stats(path):
+    #Fraction of nodata pixels, height statistics of the valid pixels and edge profiles (STATS_FIELDS)
+    with rasterio.open(path) as src:
+        data = src.read(1, masked=True)
+        top_latitude, bottom_latitude = src.bounds.top, src.bounds.bottom
+
+    valid = data.compressed()
+    nodata_fraction = 1.0 - float(valid.size) / data.size if data.size > 0 else 1.0
+
+    stats = dict.fromkeys(STATS_FIELDS)
+    stats['nodata_fraction'] = nodata_fraction
+    if data.size > 0: stats['edge_min'], stats['edge_max'] = get_edge_profiles(np.ma.getdata(data.filled(0)), top_latitude, bottom_latitude)
+
+    if valid.size == 0: return stats
+
+    stats.update(min_height=float(valid.min()), max_height=float(valid.max()), mean_height=float(valid.mean()))
+    return stats
+
+def get_edge_range(entry, profile, depth):
+    #Height range of the band or corner of EDGE_PROFILES which is depth (a fraction of the tile, in rows for the
+    #corners) deep, None if there is no profile or the band is deeper than the profile
+    step = int(math.ceil(depth * EDGE_DIVISIONS)) - 1
+    if entry['edge_min'] is None or step >= EDGE_STEPS: return None
+
+    index = EDGE_PROFILES.index(profile) * EDGE_STEPS + max(step, 0)
+    return entry['edge_min'][index], entry['edge_max'][index]
+
+class TileCatalog:
+    #Index of all tiles of a dataset, scanned once and stored as compact json.
+    #Existence and neighbour lookups go through the in-memory index instead of the filesystem.
+
+    def __init__(self, input_dir, folders=None, entries=None):
+        self.input_dir = input_dir
+        self.path = None
+        self.folders = folders if folders is not None else {}
+        self.entries = {}
+        self.paths = {}
+
+        for entry in entries or []: self.add(entry)
+
+    def add(self, entry):
+        position = (entry['latitude'], entry['longitude'])
+        self.entries[position] = entry
+        self.paths[os.path.normpath(os.path.join(self.input_dir, entry['path']))] = entry
+
+    def remove_folder(self, folder):
+        for position, entry in list(self.entries.items()):
+            if entry['path'].split('/', 1)[0] == folder:
+                del self.entries[position]
+                del self.paths[os.path.normpath(os.path.join(self.input_dir, entry['path']))]
+        self.folders.pop(folder, None)
+
+    def add_file(self, folder, file, stat):
+        latitude, longitude = string_to_position(file)
+
+        entry = {'path': folder + '/' + file, 'latitude': latitude, 'longitude': longitude, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        entry.update(dict.fromkeys(STATS_FIELDS))
+
+        self.add(entry)
+
+    def scan_folder(self, folder):
+        folder_path = os.path.join(self.input_dir, folder)
+
+        for file in sorted(os.listdir(folder_path)):
+            if not is_tile_file(file): continue
+
+            self.add_file(folder, file, os.stat(os.path.join(folder_path, file)))
+
+        self.folders[folder] = os.stat(folder_path).st_mtime_ns
+
+    def update_stats(self, tile_filter=None):
+        #Statistics are read lazily, only for the tiles which pass the filter and have none yet
+        changed = False
+        for position, entry in sorted(self.entries.items()):
+            if entry['nodata_fraction'] is not None: continue
+            if tile_filter is not None and not tile_filter(*position): continue
+
+            path = os.path.join(self.input_dir, entry['path'])
+            entry.update(get_tile_stats(path))
+            changed = True
+
+        return changed
+
+    def update(self, stats=True, tile_filter=None):
+        #Only folders which are new or whose content changed since the last scan are scanned again
+        folders = {}
+        for folder in os.listdir(self.input_dir):
+            if folder.startswith(".") or not os.path.isdir(os.path.join(self.input_dir, folder)): continue
+            folders[folder] = os.stat(os.path.join(self.input_dir, folder)).st_mtime_ns
+
+        changed = False
+        for folder in sorted(set(self.folders) - set(folders)):
+            self.remove_folder(folder)
+            changed = True
+
+        for folder, mtime in sorted(folders.items()):
+            if self.folders.get(folder) == mtime: continue
+
+            print('Scan ' + folder)
+            self.remove_folder(folder)
+            self.scan_folder(folder)
+            changed = True
+
+        if stats and self.update_stats(tile_filter): changed = True
+
+        return changed
+
+    def exists(self, path):
+        return os.path.normpath(path) in self.paths
+
+    def get(self, latitude, longitude):
+        return self.entries.get((latitude, longitude))
+
+    def get_entry(self, path):
+        return self.paths.get(os.path.normpath(path))
+
+    def get_tiles(self):
+        return sorted(self.entries)
+
+    def save(self, catalog_path=None):
+        if catalog_path is None: catalog_path = self.path
+
+        data = {'version': CATALOG_VERSION, 'folders': self.folders, 'fields': FIELDS,
+            'tiles': [[self.entries[position][field] for field in FIELDS] for position in sorted(self.entries)]}
+
+        #Nodes sharing a dataset save concurrently, every one writes its own temporary file
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(catalog_path)))
+        try:
+            with os.fdopen(handle, 'w') as file:
+                json.dump(data, file, separators=(',', ':'))
+            os.replace(tmp_path, catalog_path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, input_dir, catalog_path):
+        with open(catalog_path, 'r') as file:
+            data = json.load(file)
+
+        if data.get('version') != CATALOG_VERSION: return None
+
+        entries = [dict(zip(data['fields'], tile)) for tile in data['tiles']]
+        return cls(input_dir, data['folders'], entries)
+
+def get_catalog_path(input_dir, catalog_path=None, fallback_dir=None):
+    #Default is catalog.json in the dataset, in fallback_dir if the dataset is not writable (read-only or shared)
+    if catalog_path is not None: return catalog_path
+
+    if fallback_dir is None or os.access(input_dir, os.W_OK): return os.path.join(input_dir, CATALOG_NAME)
+    return os.path.join(fallback_dir, CATALOG_NAME)
+
+def save_catalog(catalog):
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(catalog.path)), exist_ok=True)
+        catalog.save()
+    except OSError as error:
+        print('Could not save tile catalog: {}'.format(error))
+
+def get_catalog(input_dir, catalog_path=None, rescan=False, stats=True, tile_filter=None, fallback_dir=None):
+    #Loads the catalog of a dataset and brings it up to date, the catalog is scanned on first use.
+    #Only the file names are scanned, rasters are only opened for the statistics of tiles which pass tile_filter
+    #(stats=False: never, the statistics are only needed by the direct engine and the strips of --max-memory).
+    default_path = os.path.join(input_dir, CATALOG_NAME)
+    catalog_path = get_catalog_path(input_dir, catalog_path, fallback_dir)
+
+    #A catalog in a read-only dataset is still used, changes go to the fallback
+    load_path = catalog_path if os.path.exists(catalog_path) or not os.path.exists(default_path) else default_path
+
+    catalog = None
+    if not rescan and os.path.exists(load_path): catalog = TileCatalog.load(input_dir, load_path)
+    if catalog is None: catalog = TileCatalog(input_dir)
+
+    catalog.path = catalog_path
+
+    if catalog.update(stats, tile_filter) or not os.path.exists(catalog_path): save_catalog(catalog)
+
+    return catalog
@@ -20,6 +20,8 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import math
+
 import numpy as np
 
 
@@ -30,7 +32,7 @@ def primes_from_2_to(n):
     :return: primes in 2 <= p < n.
     :rtype: list
     """
-    sieve = np.ones(n // 3 + (n % 6 == 2), dtype=np.bool)
+    sieve = np.ones(n // 3 + (n % 6 == 2), dtype=bool)
     for i in range(1, int(n ** 0.5) // 3 + 1):
         if sieve[i]:
             k = 3 * i + 1 | 1
@@ -39,42 +41,92 @@ def primes_from_2_to(n):
     return np.r_[2, 3, ((3 * np.nonzero(sieve)[0][1:] + 1) | 1)]
 
 
-def van_der_corput(n_sample, base=2):
+def first_primes(n):
+    """First n prime numbers.
+    Uses the upper bound ``p_n < n (ln n + ln ln n)`` (for ``n >= 6``) of the
+    n-th prime, so the sieve runs exactly once.
+    :param int n: number of primes.
+    :return: the first n primes.
+    :rtype: array_like (n,)
+    """
+    bound = 15
+    if n >= 6:
+        bound = int(n * (math.log(n) + math.log(math.log(n)))) + 1
+    return primes_from_2_to(bound)[:n]
+
+
+def n_digits(base):
+    """Number of digits in the given base which are resolved by a float64.
+    :param int base: base of the sequence.
+    :rtype: int
+    """
+    return int(math.ceil(53 * math.log(2) / math.log(base)))
+
+
+def digit_permutations(base, rng):
+    """Random digit permutations for scrambling.
+    :param int base: base of the sequence.
+    :param rng: numpy random ``Generator``.
+    :return: one permutation of the digits per digit position.
+    :rtype: array_like (n_digits, base)
+    """
+    return np.stack([rng.permutation(base) for _ in range(n_digits(base))])
+
+
+def van_der_corput(n_sample, base=2, start_index=0, permutations=None):
     """Van der Corput sequence.
+    The radical inverse is computed for all indices at once, one array
+    operation per digit.
     :param int n_sample: number of element of the sequence.
     :param int base: base of the sequence.
+    :param int start_index: index of the first element.
+    :param permutations: digit permutations from :func:`digit_permutations`
+        to scramble the sequence, ``None`` for the plain sequence.
     :return: sequence of Van der Corput.
-    :rtype: list (n_samples,)
+    :rtype: array_like (n_samples,)
     """
-    sequence = []
-    for i in range(n_sample):
-        n_th_number, denom = 0., 1.
-        while i > 0:
-            i, remainder = divmod(i, base)
-            denom *= base
-            n_th_number += remainder / denom
-        sequence.append(n_th_number)
+    indices = np.arange(start_index, start_index + n_sample, dtype=np.int64)
+    sequence = np.zeros(n_sample)
+
+    if permutations is None:
+        depth = 1
+        while n_sample > 0 and base ** depth <= indices[-1]:
+            depth += 1
+    else:
+        # Trailing zero digits are permuted as well
+        depth = len(permutations)
+
+    for position in range(depth):
+        indices, digits = np.divmod(indices, base)
+        if permutations is not None:
+            digits = permutations[position][digits]
+        sequence += digits / float(base) ** (position + 1)
 
     return sequence
 
 
-def halton(dim, n_sample):
+def halton(dim, n_sample, start_index=0, scramble=False, seed=None):
     """Halton sequence.
+    The first point of the underlying sequences (index 0) is skipped, so
+    ``halton(dim, n, start_index=k)`` continues ``halton(dim, k)``.
     :param int dim: dimension
     :param int n_sample: number of samples.
+    :param int start_index: number of samples to leap over.
+    :param bool scramble: use random digit permutations.
+    :param seed: seed of the digit permutations (int or numpy ``Generator``).
     :return: sequence of Halton.
     :rtype: array_like (n_samples, n_features)
     """
-    big_number = 10
-    while 'Not enought primes':
-        base = primes_from_2_to(big_number)[:dim]
-        if len(base) == dim:
-            break
-        big_number += 1000
+    base = first_primes(dim)
 
-    # Generate a sample using a Van der Corput sequence per dimension.
-    sample = [van_der_corput(n_sample + 1, dim) for dim in base]
-    sample = np.stack(sample, axis=-1)[1:]
+    rng = None
+    if scramble:
+        rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
 
-    return sample
+    # Generate a sample using a Van der Corput sequence per dimension.
+    sample = []
+    for prime in base:
+        permutations = digit_permutations(int(prime), rng) if scramble else None
+        sample.append(van_der_corput(n_sample, int(prime), start_index + 1, permutations))
 
+    return np.stack(sample, axis=-1).reshape(n_sample, dim)
@@ -1,12 +1,42 @@
 from PIL import Image
 import numpy as np
+from scipy import sparse
 import os
+import math
 import utilities
 from utilities import get_file_paths, get_pixel_width, get_target_pixel_dimensions
 
 
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.warp import calculate_default_transform, reproject, transform_bounds, Resampling
+from rasterio.windows import Window
+from affine import Affine
+
+from metrics import stage, count
+
+RESAMPLING = Resampling.nearest
+
+#Height of voids (nodata pixels of the tiles) and placeholders in the mosaic
+NODATA_HEIGHT = 0.0
+
+#Resampling of reduced resolution reads of the source tiles (uses the overviews of a tile if it has any)
+DECIMATION_RESAMPLING = Resampling.average
+
+tile_cache = None
+
+def set_tile_cache(cache):
+    global tile_cache
+    tile_cache = cache
+    
+tile_catalog = None
+
+def set_tile_catalog(catalog):
+    global tile_catalog
+    tile_catalog = catalog
+    
+def tile_exists(path):
+    if tile_catalog is None: return os.path.exists(path)
+    return tile_catalog.exists(path)
     
 def get_neighbours(latitude, longitude):
     
@@ -23,6 +53,18 @@ def get_neighbours(latitude, longitude):
     
     return lats, lons
     
+def get_neighbourhood_paths(path_to_dataset, latitude, longitude):
+    lats, lons = get_neighbours(latitude, longitude)
+    
+    paths = []
+    for lat in lats:
+        if lat is None: continue
+        for lon in lons:
+            file_name, folder_name = get_file_paths(lat, lon)
+            paths.append(os.path.join(path_to_dataset, folder_name, file_name))
+            
+    return paths
+    
 def get_placeholder(latitude,target_width):
     actual_width = get_pixel_width(latitude)
     scale_factor = float(target_width) / float(actual_width)
@@ -30,176 +72,446 @@ def get_placeholder(latitude,target_width):
     scaled_height = int(utilities.IMAGE_HEIGHT*scale_factor)
 
     #swap width and height to match pillow
-    return np.zeros((scaled_height,scaled_width))
+    return np.zeros((scaled_height,scaled_width), np.float32)
+    
+def get_tile_dimensions(latitude, longitude, decimation=1):
+    #Size of a reprojected tile read at 1/decimation of the resolution
+    width, height = get_target_pixel_dimensions(latitude, longitude)
+    return max(width // decimation, 1), max(height // decimation, 1)
+    
+def decimate_transform(transform, width, height, decimation=1):
+    #Same bounds with width and height reduced by the decimation factor
+    if decimation <= 1: return transform, width, height
+    
+    decimated_width, decimated_height = max(width // decimation, 1), max(height // decimation, 1)
+    return transform * Affine.scale(float(width) / decimated_width, float(height) / decimated_height), decimated_width, decimated_height
+    
+def read_source(src, window=None, decimation=1):
+    #Band 1 (of a window) and its transform, at reduced resolution the pixels are averaged by GDAL
+    transform = src.window_transform(window) if window is not None else src.transform
+    if decimation <= 1: return src.read(1, window=window), transform
     
-def get_mercator_projected_image(path):
-    with rasterio.open(path) as src:
+    width, height = (int(window.width), int(window.height)) if window is not None else (src.width, src.height)
+    transform, decimated_width, decimated_height = decimate_transform(transform, width, height, decimation)
+    
+    return src.read(1, window=window, out_shape=(decimated_height, decimated_width), resampling=DECIMATION_RESAMPLING), transform
+    
+def align_window(window, decimation):
+    #Smallest window around window whose edges are multiples of decimation
+    col_off, row_off = window.col_off // decimation * decimation, window.row_off // decimation * decimation
+    col_stop = -(-(window.col_off + window.width) // decimation) * decimation
+    row_stop = -(-(window.row_off + window.height) // decimation) * decimation
+    
+    return Window(col_off, row_off, col_stop - col_off, row_stop - row_off)
+    
+def fill_nodata(image, nodata):
+    #Voids of a reprojected tile (marked with the nodata value of the source) get NODATA_HEIGHT, in place
+    if nodata is not None: image[image == nodata] = NODATA_HEIGHT
+    
+def get_cache_resampling(decimation=1):
+    #Reduced resolution tiles are cached separately
+    if decimation <= 1: return RESAMPLING.name
+    return '{}-{}'.format(RESAMPLING.name, decimation)
+    
+def get_mercator_projected_image(path, decimation=1):
+    if tile_cache is None: return reproject_image(path, decimation)
+    
+    return tile_cache.get_or_create(path, utilities.OUTPUT_PROJECTION, get_cache_resampling(decimation), lambda: reproject_image(path, decimation))
+    
+def reproject_image(path, decimation=1):
+    with stage('reprojection'), rasterio.open(path) as src:
         transform, width, height = calculate_default_transform(
             src.crs, utilities.OUTPUT_PROJECTION, src.width, src.height, *src.bounds)
+        transform, width, height = decimate_transform(transform, width, height, decimation)
 
         destination = np.zeros((height,width), np.float32)
+        
+        source, src_transform = rasterio.band(src, 1), src.transform
+        if decimation > 1: source, src_transform = read_source(src, decimation=decimation)
 
         reproject(
-            source=rasterio.band(src, 1),
+            source=source,
             destination=destination,#rasterio.band(dst, i),
-            src_transform=src.transform,
+            src_transform=src_transform,
             src_crs=src.crs,
+            src_nodata=src.nodata,
             dst_transform=transform,
             dst_crs=utilities.OUTPUT_PROJECTION,
-            resampling=Resampling.nearest)
+            resampling=RESAMPLING)
+        fill_nodata(destination, src.nodata)
+            
+        count('tiles_reprojected')
+        count('bytes_read', src.width * src.height * np.dtype(src.dtypes[0]).itemsize // decimation**2)
 
     return destination
     
-def get_current_image(path, tile_pos, offset, width, height):
-
-    if tile_pos == (1,1): return get_mercator_projected_image(path), False
+def get_mercator_projected_strip(path, rows, cols, decimation=1):
+    #Serve the strip from the full tile if it has already been reprojected
+    if tile_cache is not None:
+        image_array = tile_cache.get(path, utilities.OUTPUT_PROJECTION, get_cache_resampling(decimation))
+        if image_array is not None: return image_array[rows[0]:rows[1], cols[0]:cols[1]]
         
+    return reproject_strip(path, rows, cols, decimation)
     
-    top_bottom_height = offset
-    top_bottom_width = width
-    
-    left_right_height = height
-    left_right_width = offset
+def reproject_strip(path, rows, cols, decimation=1):
+    with stage('reprojection'), rasterio.open(path) as src:
+        transform, width, height = calculate_default_transform(
+            src.crs, utilities.OUTPUT_PROJECTION, src.width, src.height, *src.bounds)
+        transform, width, height = decimate_transform(transform, width, height, decimation)
+        
+        #Same semantics as slicing the fully reprojected tile
+        row_start, row_stop, _ = slice(*rows).indices(height)
+        col_start, col_stop, _ = slice(*cols).indices(width)
+        
+        strip_height = max(row_stop - row_start, 0)
+        strip_width = max(col_stop - col_start, 0)
+        
+        destination = np.zeros((strip_height,strip_width), np.float32)
+        if destination.size == 0: return destination
+        
+        window = Window(col_start, row_start, strip_width, strip_height)
+        window_transform = rasterio.windows.transform(window, transform)
+        
+        #Only read the source pixels covered by the strip (plus a small safety margin)
+        window_bounds = rasterio.windows.bounds(window, transform)
+        src_bounds = transform_bounds(utilities.OUTPUT_PROJECTION, src.crs, *window_bounds)
+        
+        src_window = src.window(*src_bounds)
+        col_off = math.floor(src_window.col_off) - 2
+        row_off = math.floor(src_window.row_off) - 2
+        src_window = Window(col_off, row_off, math.ceil(src_window.width) + 5, math.ceil(src_window.height) + 5)
+        
+        #Decimated reads average the same blocks as a read of the whole tile
+        if decimation > 1: src_window = align_window(src_window, decimation)
+        
+        src_window = src_window.intersection(Window(0, 0, src.width, src.height))
+        
+        source, src_transform = read_source(src, src_window, decimation)
+        
+        count('strips_reprojected')
+        count('bytes_read', source.nbytes)
+
+        reproject(
+            source=source,
+            destination=destination,
+            src_transform=src_transform,
+            src_crs=src.crs,
+            src_nodata=src.nodata,
+            dst_transform=window_transform,
+            dst_crs=utilities.OUTPUT_PROJECTION,
+            resampling=RESAMPLING)
+        fill_nodata(destination, src.nodata)
+
+    return destination
     
-    use_placeholder = not os.path.exists(path)
+def get_crop(tile_pos, offset, width, height):
+    #Rows and columns (start, stop) of the reprojected tile at tile_pos (column, row) which are part of the mosaic,
+    #the top and bottom tiles give offset rows, the left and right tiles offset columns
+    crop_top, crop_bottom = 0, height
+    crop_left, crop_right = 0, width
     
-    current_width = 0
-    current_height = 0
+    if tile_pos[1] == 0:
+        #Top
+        crop_top = crop_bottom - offset
     
-    crop_top = 0
-    crop_bottom = height
-    crop_left = 0
-    crop_right = width
+    if tile_pos[1] == 2:
+        #Bottom
+        crop_bottom = offset
     
-
-    if tile_pos[1] == 0 or tile_pos[1] == 2:
-        current_height = top_bottom_height
-        
-        if tile_pos[1] == 0:
-            #Top
-            crop_top = crop_bottom - current_height
+    if tile_pos[0] == 0:
+        #Left
+        crop_left = crop_right - offset
         
-        if tile_pos[1] == 2:
-            #Bottom
-            crop_bottom = current_height
+    if tile_pos[0] == 2:
+        #Right
+        crop_right = offset
         
-        if tile_pos[0] == 0:
-            #Left
-            current_width = left_right_width
-            crop_left = crop_right - current_width
-            
-        if tile_pos[0] == 2:
-            #Right
-            current_width = left_right_width
-            crop_right = current_width
-            
-        if tile_pos[0] == 1:
-            #Center
-            current_width = width
+    return (crop_top, crop_bottom), (crop_left, crop_right)
     
-    if tile_pos[1] == 1:
-        current_width = left_right_width
-        current_height = left_right_height
+def get_current_image(path, tile_pos, offset, width, height, decimation=1, rows=None):
+    #With rows (start, stop) only these rows of the cropped image are reprojected
+
+    if tile_pos == (1,1):
+        if rows is None: return get_mercator_projected_image(path, decimation), False
+        return get_mercator_projected_strip(path, rows, (0, width), decimation), False
         
-        if tile_pos[0] == 0:
-            #Left
-            crop_left = crop_right - current_width
-            
-        if tile_pos[0] == 2:
-            #Right
-            crop_right = current_width
+    (crop_top, crop_bottom), (crop_left, crop_right) = get_crop(tile_pos, offset, width, height)
+    
+    if rows is not None: crop_top, crop_bottom = crop_top + rows[0], crop_top + rows[1]
         
-    if use_placeholder == False:
-        print(path)
-        image_array = get_mercator_projected_image(path)
-
-        cropped = image_array[crop_top:crop_bottom, crop_left:crop_right]
+    if tile_exists(path):
+        cropped = get_mercator_projected_strip(path, (crop_top, crop_bottom), (crop_left, crop_right), decimation)
         return cropped, False
         
     else:
-        print('Load Placeholder')
-        return np.zeros((current_height,current_width)), True
+        count('placeholders')
+        return np.zeros((crop_bottom - crop_top, crop_right - crop_left), np.float32), True
         
         
-def get_row(path_to_dataset,row,offset,target_width, lons, lat):
+def get_row_shape(row, lat, lon, offset, target_width, decimation=1):
+    #Width of the tiles and strips of a row (before scaling) and the height of the row
+    row_width, row_height = get_tile_dimensions(lat,lon, decimation)
     
-    image_row = None
+    offset = int(offset*float(row_width)/target_width)
     
-    row_width, row_height = get_target_pixel_dimensions(lat,lons[0])
+    if row != 1: row_height = offset
     
-    offset = int(offset*float(row_width)/target_width)
+    return [offset, row_width, offset], row_height
+    
+def get_row(path_to_dataset,row,offset,target_width, lons, lat, destination=None, decimation=1, rows=None):
+    
+    column_widths, height = get_row_shape(row, lat, lons[0], offset, target_width, decimation)
+    if rows is not None: height = rows[1] - rows[0]
+    
+    row_width, row_height = get_tile_dimensions(lat,lons[0], decimation)
+    offset = column_widths[0]
+    
+    #Every tile is copied once into its slice of the row
+    if destination is None: destination = np.zeros((height, sum(column_widths)), np.float32)
     
     placholders = [True,True,True]
-
+    
+    col_start = 0
     for col, lon in enumerate(lons):
 
         file_name,folder_name = get_file_paths(lat,lon)
 
         path = os.path.join(path_to_dataset, folder_name, file_name)
         
-        image, is_placeholder  = get_current_image(path, (col, row), offset, row_width, row_height)
+        image, is_placeholder  = get_current_image(path, (col, row), offset, row_width, row_height, decimation, rows)
         placholders[col] = is_placeholder
-    
-        if image_row is None: image_row = image
-        else: image_row = np.concatenate((image_row, image), axis = 1)
+        
+        #Placeholders stay zero
+        if not is_placeholder: destination[:image.shape[0], col_start:col_start+image.shape[1]] = image
+        
+        col_start += column_widths[col]
             
-    return image_row, placholders
+    return destination, placholders
     
-def scale_row(row, target_width=None):
-
-    row_image = Image.fromarray(np.uint8(row * 255), 'L')
-    width, height = row_image.size
-
-    if target_width is not None:
-        factor = float(target_width)/width
-        width = target_width
-        height = int(factor*height)
+def lanczos(x):
+    return np.where(np.abs(x) < 3.0, np.sinc(x) * np.sinc(x / 3.0), 0.0)
+    
+def get_resample_matrix(in_size, out_size):
+    #Sparse matrix of the Lanczos (antialiasing) weights, same kernel and support as PIL's ANTIALIAS
+    scale = float(in_size) / out_size
+    filter_scale = max(scale, 1.0)
+    support = 3.0 * filter_scale
+    
+    centers = (np.arange(out_size) + 0.5) * scale
+    starts = np.maximum((centers - support + 0.5).astype(np.int64), 0)
+    stops = np.minimum((centers + support + 0.5).astype(np.int64), in_size)
+    
+    taps = np.arange(int(math.ceil(support)) * 2 + 1)
+    indices = starts[:, None] + taps[None, :]
+    
+    weights = lanczos((indices - centers[:, None] + 0.5) / filter_scale)
+    weights[indices >= stops[:, None]] = 0.0
+    
+    total = weights.sum(axis=1, keepdims=True)
+    weights = np.divide(weights, total, out=np.zeros_like(weights), where=total != 0)
+    
+    rows = np.repeat(np.arange(out_size), len(taps))
+    matrix = sparse.csr_matrix((weights.ravel(), (rows, np.minimum(indices, in_size - 1).ravel())), shape=(out_size, in_size), dtype=np.float32)
+    return matrix
+    
+def resample(image, destination):
+    #Separable resize of image into the destination array (horizontal pass first like PIL)
+    height, width = destination.shape
+    
+    if image.shape[1] != width: image = (get_resample_matrix(image.shape[1], width) @ image.T).T
+        
+    if image.shape[0] != height: image = get_resample_matrix(image.shape[0], height) @ image
+    
+    destination[...] = image
+    return destination
+    
+def resample_rows(get_rows, in_height, shape, rows):
+    #Rows (start, stop) of resample(image, destination) for an image of in_height rows and a destination of this shape.
+    #get_rows(start, stop) only has to return the rows of the image under the Lanczos kernels of these rows.
+    height, width = shape
     
-    scaled_image = row_image.resize([width,height],Image.ANTIALIAS)
-    return scaled_image
+    matrix = None
+    in_rows = rows
+    if in_height != height:
+        matrix = get_resample_matrix(in_height, height)[rows[0]:rows[1]]
+        in_rows = (int(matrix.indices.min()), int(matrix.indices.max()) + 1)
+        matrix = matrix[:, in_rows[0]:in_rows[1]]
     
+    image = get_rows(*in_rows)
     
-def get_image(path_to_dataset, latitude,longitude, offset=0):
+    if image.shape[1] != width: image = (get_resample_matrix(image.shape[1], width) @ image.T).T
+    
+    if matrix is not None: image = matrix @ image
+    
+    return image
+    
+def normalize_image(image, min_height, max_height, bit_depth=8):
+    #In place, 8 bit images are quantized to 0..255 but stay float32
+    scale = 1.0 / (max_height-min_height) if max_height > min_height else 0.0
+    
+    np.subtract(image, min_height, out=image)
+    np.multiply(image, scale, out=image)
+    
+    if bit_depth == 16: return image
+    
+    np.multiply(image, 255, out=image)
+    np.clip(image, 0, 255, out=image)
+    np.floor(image, out=image)
+    
+    return image
+    
+def get_preview(image, bit_depth=8):
+    if bit_depth == 16: image = image * 255
+    return Image.fromarray(image.astype(np.uint8), 'L')
+    
+    
+def get_mosaic_layout(latitude, longitude, offset=0, decimation=1):
+    #Heights of the top margin, the middle row and the bottom margin and the width of the mosaic,
+    #the top and bottom rows are scaled to the width of the middle row (offset in pixels of the decimated mosaic)
+    lats,lons = get_neighbours(latitude,longitude)
 
+    target_width, target_height = get_tile_dimensions(latitude,longitude, decimation)
+    
+    middle_widths, image_height = get_row_shape(1, lats[1], lons[0], offset, target_width, decimation)
+    top_widths, top_height = get_row_shape(0, lats[0], lons[0], offset, target_width, decimation)
+    bottom_widths, bottom_height = get_row_shape(2, lats[2], lons[0], offset, target_width, decimation)
+    
+    width = sum(middle_widths)
+    top_margin = int(float(width)/sum(top_widths)*top_height)
+    bottom_margin = int(float(width)/sum(bottom_widths)*bottom_height)
+    
+    return (top_margin, image_height, bottom_margin), width
+    
+class MosaicScale:
+    #Maps pixels of the full resolution mosaic (offset pixels of margin) to the mosaic of get_image at 1/decimation
+    #of the resolution. Sample positions are always placed at full resolution, so they do not depend on the decimation.
+    
+    def __init__(self, latitude, longitude, offset=0, decimation=1):
+        width, height = get_target_pixel_dimensions(latitude, longitude)
+        decimated_width, decimated_height = get_tile_dimensions(latitude, longitude, decimation)
+        
+        self.decimation = decimation
+        self.offset = offset
+        self.image_offset = offset // decimation
+        self.scale = np.array([float(decimated_width) / width, float(decimated_height) / height])
+        
+    def to_image(self, points):
+        if self.decimation <= 1: return np.asarray(points)
+        return (np.asarray(points) - self.offset) * self.scale + self.image_offset
+        
+    def to_image_length(self, length):
+        if self.decimation <= 1: return length
+        return length * float(np.mean(self.scale))
+    
+def get_decimation(edge_lengths_pixel, output_sizes, max_decimation=1):
+    #Largest factor at which every patch is still cut from at least as many pixels as it has
+    factors = [int(edge_length_pixel // output_size) if output_size else 1 for edge_length_pixel, output_size in zip(edge_lengths_pixel, output_sizes)]
+    return max(min(factors + [max_decimation]), 1)
+    
+def get_placeholders(path_to_dataset, latitude, longitude):
+    #Same layout as the placeholders of get_image, the center tile is never a placeholder
+    lats,lons = get_neighbours(latitude,longitude)
+    
+    placeholders = [[False, False, False] for _ in lats]
+    for row, lat in enumerate(lats):
+        for col, lon in enumerate(lons):
+            if (row, col) == (1, 1): continue
+            
+            file_name, folder_name = get_file_paths(lat, lon)
+            placeholders[row][col] = not tile_exists(os.path.join(path_to_dataset, folder_name, file_name))
+        
+    return placeholders
+    
+def get_neighbourhood_crops(path_to_dataset, latitude, longitude, offset=0, decimation=1):
+    #(path, (latitude, longitude), tile position (column, row), rows, columns) of the parts of the reprojected 3x3 tiles
+    #in the mosaic of get_image
+    lats,lons = get_neighbours(latitude,longitude)
+    
+    target_width, target_height = get_tile_dimensions(latitude,longitude, decimation)
+    offset = offset // decimation
+    
+    crops = []
+    for row, lat in enumerate(lats):
+        row_offset = get_row_shape(row, lat, lons[0], offset, target_width, decimation)[0][0]
+        row_width, row_height = get_tile_dimensions(lat, lons[0], decimation)
+        
+        for col, lon in enumerate(lons):
+            file_name, folder_name = get_file_paths(lat, lon)
+            rows, cols = get_crop((col, row), row_offset, row_width, row_height)
+            crops.append((os.path.join(path_to_dataset, folder_name, file_name), (lat, lon), (col, row), rows, cols))
+            
+    return crops
+    
+def get_image_rows(path_to_dataset, latitude, longitude, offset, start, stop, decimation=1):
+    #Rows start:stop of the mosaic of get_image before it is normalized,
+    #only the rows of the tiles under them are reprojected
+    lats,lons = get_neighbours(latitude,longitude)
+    
+    target_width, target_height = get_tile_dimensions(latitude,longitude, decimation)
+    offset = offset // decimation
+    
+    (top_margin, image_height, bottom_margin), width = get_mosaic_layout(latitude, longitude, offset, decimation)
+    
+    image = np.zeros((stop-start, width), np.float32)
+    
+    for row, row_start, row_height in [(0, 0, top_margin), (1, top_margin, image_height), (2, top_margin+image_height, bottom_margin)]:
+        part_start, part_stop = max(start, row_start), min(stop, row_start+row_height)
+        if part_start >= part_stop: continue
+        
+        destination = image[part_start-start:part_stop-start]
+        rows = (part_start-row_start, part_stop-row_start)
+        
+        if row == 1:
+            get_row(path_to_dataset,row,offset,target_width,lons,lats[row], destination, decimation, rows)
+            continue
+        
+        #Top and bottom rows are scaled to the width of the middle row
+        def get_rows(in_start, in_stop):
+            return get_row(path_to_dataset,row,offset,target_width,lons,lats[row], decimation=decimation, rows=(in_start, in_stop))[0]
+        
+        in_height = get_row_shape(row, lats[row], lons[0], offset, target_width, decimation)[1]
+        destination[...] = resample_rows(get_rows, in_height, (row_height, width), rows)
+    
+    return image
+    
+def get_image(path_to_dataset, latitude,longitude, offset=0, bit_depth=8, decimation=1, nodata_mask=False):
+    #With a decimation factor the tiles are read at reduced resolution and the mosaic is smaller by that factor,
+    #see MosaicScale for the coordinates.
+    #With nodata_mask the mask of the NODATA_HEIGHT pixels (before normalization) is returned as well
     file_name, folder_name = get_file_paths(latitude,longitude)
     path = os.path.join(path_to_dataset, folder_name, file_name)
     
-    if not os.path.exists(path): return None
+    if not tile_exists(path): return None
 
-    print('\nProcess ' + file_name)
     lats,lons = get_neighbours(latitude,longitude)
 
-    target_width, target_height = get_target_pixel_dimensions(latitude,longitude)
-
-    #Get rows
-    middle_row, middle_placeholders = get_row(path_to_dataset,1,offset,target_width,lons,lats[1])
-    top_row, top_placeholders = get_row(path_to_dataset,0,offset,target_width,lons,lats[0])
-    bottom_row, bottom_placeholders = get_row(path_to_dataset,2,offset,target_width,lons,lats[2])
-    
-    #Normalize images
-    max_height = np.max([np.max(middle_row),np.max(top_row),np.max(bottom_row)])
-    min_height = np.min([np.min(middle_row),np.min(top_row),np.min(bottom_row)])
+    target_width, target_height = get_tile_dimensions(latitude,longitude, decimation)
+    offset = offset // decimation
     
-    middle_row = (middle_row - min_height) / (max_height-min_height)
-    top_row = (top_row - min_height) / (max_height-min_height)
-    bottom_row = (bottom_row - min_height) / (max_height-min_height)
+    (top_margin, image_height, bottom_margin), width = get_mosaic_layout(latitude, longitude, offset, decimation)
     
-    #Scale patches
-    middle_row_image = scale_row(middle_row)
-    top_row_image = scale_row(top_row,target_width=middle_row_image.size[0])
-    bottom_row_image = scale_row(bottom_row,target_width=middle_row_image.size[0])
+    image = np.zeros((top_margin+image_height+bottom_margin, width), np.float32)
+
+    #Get rows, the middle row is loaded directly into the mosaic
+    _, middle_placeholders = get_row(path_to_dataset,1,offset,target_width,lons,lats[1], image[top_margin:top_margin+image_height], decimation)
+    top_row, top_placeholders = get_row(path_to_dataset,0,offset,target_width,lons,lats[0], decimation=decimation)
+    bottom_row, bottom_placeholders = get_row(path_to_dataset,2,offset,target_width,lons,lats[2], decimation=decimation)
     
-    top_margin = top_row_image.size[1]
-    bottom_margin = bottom_row_image.size[1]
+    rows = [image[top_margin:top_margin+image_height], top_row, bottom_row]
+    max_height = max(np.max(row) for row in rows)
+    min_height = min(np.min(row) for row in rows)
     
-    image_height = middle_row_image.size[1]
+    #Scale rows
+    resample(top_row, image[:top_margin])
+    del top_row
+    resample(bottom_row, image[top_margin+image_height:])
+    del bottom_row
     
-    image = Image.new('L', (middle_row.shape[1], top_margin+image_height+bottom_margin), 0)
+    mask = image == NODATA_HEIGHT if nodata_mask else None
     
-    image.paste(top_row_image, (0, 0))
-    image.paste(middle_row_image, (0, top_margin))
-    image.paste(bottom_row_image, (0, top_margin + image_height))
+    normalize_image(image, min_height, max_height, bit_depth)
 
     placeholders = [top_placeholders,middle_placeholders,bottom_placeholders]
 
+    if nodata_mask: return image, min_height, max_height, placeholders, mask
     return image, min_height, max_height, placeholders
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+
+COLUMNS = ['Filename', 'Latitude', 'Longitude', 'Rotation', 'MinHeight', 'MaxHeight']
+HEADER = ';'.join(COLUMNS) + '\n'
+
+BUFFER_SIZE = 1024 * 1024
+
+SHARD_DIR = 'labels_shards'
+
+def format_label(file_name, latitude, longitude, rotation, min_height, max_height):
+    return "{};{};{};{};{};{}\n".format(file_name, latitude, longitude, rotation, min_height, max_height)
+
+def label_to_line(label):
+    return format_label(*[label[name] for name in COLUMNS])
+
+class LabelsWriter:
+    #Keeps one buffered handle open instead of reopening the labels file for every sample
+
+    def __init__(self, path, mode='a', buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.file = open(path, mode, buffering=buffer_size)
+
+    def write(self, file_name, latitude, longitude, rotation, min_height, max_height):
+        self.file.write(format_label(file_name, latitude, longitude, rotation, min_height, max_height))
+
+    def write_lines(self, lines):
+        self.file.writelines(lines)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#One writer per process and shard directory, every process appends to its own shard
+shard_writers = {}
+
+def get_shard_writer(shard_dir):
+    shard_path = os.path.join(shard_dir, 'labels-{}.csv'.format(os.getpid()))
+
+    if shard_path not in shard_writers:
+        if not os.path.exists(shard_dir): os.makedirs(shard_dir, exist_ok=True)
+        shard_writers[shard_path] = LabelsWriter(shard_path)
+
+    return shard_writers[shard_path]
+
+def close_shard_writer():
+    for writer in shard_writers.values(): writer.close()
+    shard_writers.clear()
+
+def get_shard_paths(shard_dir):
+    if not os.path.exists(shard_dir): return []
+    return sorted(os.path.join(shard_dir, file) for file in os.listdir(shard_dir) if file.endswith('.csv'))
+
+def get_line_tile_prefix(line):
+    return line.split(';', 1)[0].replace('\\', '/').split('/', 1)[0]
+
+def group_lines(lines):
+    tiles = {}
+    for line in lines:
+        tiles.setdefault(get_line_tile_prefix(line), []).append(line)
+
+    return tiles
+
+def read_shards(shard_dir):
+    #Lines of all shards grouped by tile
+    lines = []
+    for shard_path in get_shard_paths(shard_dir):
+        with open(shard_path, 'r') as file:
+            lines.extend(file.readlines())
+
+    return group_lines(lines)
+
+def read_label_lines(path):
+    if path.endswith('.npz'):
+        labels = read_labels(path)
+        return [label_to_line({name: labels[name][row] for name in COLUMNS}) for row in range(len(labels[COLUMNS[0]]))]
+
+    with open(path, 'r') as file:
+        return [line for line in file.readlines()[1:] if line.strip()]
+
+def write_labels(output_path, tiles, tile_order, labels_format='csv'):
+    #Tiles are written in the given tile order, so the result does not depend on
+    #which worker processed a tile
+    ordered_tiles = [tile for tile in tile_order if tile in tiles]
+    ordered_tiles += sorted(set(tiles) - set(ordered_tiles))
+
+    lines = [line for tile in ordered_tiles for line in tiles[tile]]
+
+    if labels_format == 'npz': write_columnar(output_path, lines)
+    else:
+        with LabelsWriter(output_path, 'w') as writer:
+            writer.write_lines([HEADER])
+            writer.write_lines(lines)
+
+def merge_shards(shard_dir, output_path, tile_order, labels_format='csv', previous=None):
+    #Lines of a tile in the shards replace the lines of the same tile in previous
+    tiles = dict(previous) if previous is not None else {}
+    tiles.update(read_shards(shard_dir))
+
+    write_labels(output_path, tiles, tile_order, labels_format)
+
+    clear_shards(shard_dir)
+
+def clear_shards(shard_dir):
+    for shard_path in get_shard_paths(shard_dir):
+        os.remove(shard_path)
+    if os.path.exists(shard_dir) and len(os.listdir(shard_dir)) == 0: os.rmdir(shard_dir)
+
+def parse_lines(lines):
+    rows = [line.rstrip('\n').split(';') for line in lines if line.strip()]
+    columns = list(zip(*rows)) if len(rows) > 0 else [[] for _ in COLUMNS]
+
+    labels = {COLUMNS[0]: np.array(columns[0], dtype=str)}
+    for name, column in zip(COLUMNS[1:], columns[1:]):
+        labels[name] = np.array(column, dtype=np.float64)
+
+    return labels
+
+def write_columnar(output_path, lines):
+    np.savez(output_path, **parse_lines(lines))
+
+def read_labels(path):
+    #Columns of a labels file as dictionary of arrays (csv or npz)
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return {name: data[name] for name in COLUMNS}
+
+    with open(path, 'r') as file:
+        return parse_lines(file.readlines()[1:])
@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+def get_params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_fingerprint(path):
+    #Size and modification time of an input, None if it does not exist (placeholder)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+def get_catalog_fingerprint(catalog, path):
+    entry = catalog.get_entry(path)
+    if entry is None: return None
+
+    return [entry['size'], entry['mtime']]
+
+def get_inputs(input_dir, paths, catalog=None):
+    if catalog is not None: return {os.path.relpath(path, input_dir): get_catalog_fingerprint(catalog, path) for path in paths}
+
+    return {os.path.relpath(path, input_dir): get_fingerprint(path) for path in paths}
+
+class Manifest:
+    #Append only record of the completed tiles of an output directory.
+    #A tile is complete if its last entry has the same parameters and inputs.
+
+    def __init__(self, output_dir, name=MANIFEST_NAME):
+        self.path = os.path.join(output_dir, name)
+        self.tiles = {}
+
+        if os.path.exists(self.path): self.load()
+
+    def load(self):
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #Last line of a crashed run
+                    continue
+                self.tiles[entry['tile']] = entry
+
+    def reset(self):
+        self.tiles = {}
+        if os.path.exists(self.path): os.remove(self.path)
+
+    def is_complete(self, tile, params_hash, inputs):
+        entry = self.tiles.get(tile)
+        if entry is None: return False
+
+        return entry['params'] == params_hash and entry['inputs'] == inputs
+
+    def record(self, tile, params_hash, inputs, samples):
+        entry = {'tile': tile, 'params': params_hash, 'inputs': inputs, 'samples': samples}
+        self.tiles[tile] = entry
+
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(entry, sort_keys=True) + '\n')
@@ -0,0 +1,210 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+
+#Stages in the order of the summary table, other stages are appended
+STAGES = ['mosaic', 'reprojection', 'points', 'filter', 'extraction', 'encode', 'write', 'labels']
+
+class TileMetrics:
+    #Stage timings (exclusive, time spent in nested stages is not counted twice) and counters of one tile
+
+    def __init__(self, tile):
+        self.tile = tile
+        self.time = 0.0
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+        #Open stages as [name, start, time of nested stages]
+        self.stack = []
+
+    def enter(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def exit(self):
+        name, start, nested = self.stack.pop()
+        elapsed = time.perf_counter() - start
+
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed - nested
+        if self.stack: self.stack[-1][2] += elapsed
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, elapsed):
+        #Time of a stage which ran in another thread
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def suspend(self):
+        self.time += time.perf_counter() - self.start
+
+    def resume(self):
+        self.start = time.perf_counter()
+
+    def to_record(self):
+        return {'tile': self.tile, 'pid': os.getpid(), 'time': self.time, 'stages': self.stages, 'counters': self.counters}
+
+#Metrics of the tile processed by the current thread, None outside of start_tile / finish_tile.
+#A tile can be loaded by one thread and sampled by another (see suspend_tile / resume_tile).
+state = threading.local()
+
+def get_current():
+    return getattr(state, 'current', None)
+
+def start_tile(tile):
+    state.current = TileMetrics(tile)
+
+def suspend_tile():
+    #Detaches the metrics of the current tile from this thread, only active time is counted
+    current = get_current()
+    if current is not None: current.suspend()
+
+    state.current = None
+    return current
+
+def resume_tile(metrics):
+    if metrics is not None: metrics.resume()
+    state.current = metrics
+
+def finish_tile():
+    current = suspend_tile()
+    if current is None: return None
+
+    return current.to_record()
+
+def count(name, value=1):
+    current = get_current()
+    if current is not None: current.count(name, value)
+
+def add_time(name, elapsed):
+    current = get_current()
+    if current is not None: current.add_time(name, elapsed)
+
+#Stages which are run under cProfile, the stats are written per process (and thread) into profile_dir
+profile_stages = set()
+profile_dir = None
+
+#cProfile only sees the thread which enabled it, so every thread gets its own profiler
+profilers = []
+profile_lock = threading.Lock()
+
+def set_profiling(stages, output_dir):
+    global profile_stages, profile_dir
+
+    profile_stages = set(stages or [])
+    profile_dir = output_dir
+
+def get_profiler():
+    #Profilers which were already written by close_profiler are replaced
+    if getattr(state, 'profiler', None) not in profilers:
+        state.profiler = cProfile.Profile()
+        state.profile_depth = 0
+
+        with profile_lock:
+            if not profilers: Finalize(None, close_profiler, exitpriority=10)
+            profilers.append(state.profiler)
+
+    return state.profiler
+
+@contextmanager
+def profile(name):
+    if name not in profile_stages:
+        yield
+        return
+
+    profiler = get_profiler()
+
+    #Nested profiled stages keep the profiler of the outer stage running
+    if state.profile_depth == 0: profiler.enable()
+    state.profile_depth += 1
+    try:
+        yield
+    finally:
+        state.profile_depth -= 1
+        if state.profile_depth == 0: profiler.disable()
+
+def close_profiler():
+    #Stats of all profiled stages of this process, can be merged with pstats.Stats(*paths)
+    with profile_lock:
+        if not profilers: return
+
+        os.makedirs(profile_dir, exist_ok=True)
+        for index, profiler in enumerate(profilers):
+            suffix = '-{}'.format(index) if index > 0 else ''
+            profiler.dump_stats(os.path.join(profile_dir, 'profile-{}{}.prof'.format(os.getpid(), suffix)))
+
+        del profilers[:]
+
+@contextmanager
+def stage(name):
+    with profile(name):
+        metrics = get_current()
+        if metrics is None:
+            yield
+            return
+
+        metrics.enter(name)
+        try:
+            yield
+        finally:
+            metrics.exit()
+
+def timed_iter(iterable, name):
+    #Time spent producing the items of a (lazy) iterable is recorded as stage name
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+class MetricsWriter:
+    #Collects the records of all tiles, writes them as json lines and sums them up for the summary table
+
+    def __init__(self, path=None):
+        self.file = open(path, 'a') if path is not None else None
+
+        self.tiles = 0
+        self.time = 0.0
+        self.stages = {}
+        self.counters = {}
+
+    def write(self, record):
+        if record is None: return
+
+        self.tiles += 1
+        self.time += record['time']
+        for name, value in record['stages'].items(): self.stages[name] = self.stages.get(name, 0.0) + value
+        for name, value in record['counters'].items(): self.counters[name] = self.counters.get(name, 0) + value
+
+        if self.file is not None:
+            self.file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None: self.file.close()
+        self.file = None
+
+    def get_summary(self):
+        lines = ['{:<20} {:>10} {:>10} {:>7}'.format('Stage', 'Total (s)', 'Tile (ms)', 'Share')]
+
+        names = [name for name in STAGES if name in self.stages] + sorted(set(self.stages) - set(STAGES))
+        other = self.time - sum(self.stages.values())
+
+        for name, value in [(name, self.stages[name]) for name in names] + [('other', other)]:
+            share = value / self.time if self.time > 0 else 0.0
+            lines.append('{:<20} {:>10.2f} {:>10.1f} {:>6.1f}%'.format(name, value, value * 1000 / max(self.tiles, 1), share * 100))
+
+        lines.append('')
+        lines.append('{:<20} {:>10}'.format('Counter', 'Total'))
+        lines.append('{:<20} {:>10}'.format('tiles', self.tiles))
+        for name in sorted(self.counters):
+            lines.append('{:<20} {:>10}'.format(name, self.counters[name]))
+
+        return '\n'.join(lines)
@@ -0,0 +1,74 @@
+import numpy as np
+from scipy import ndimage
+
+#Number of patches which are interpolated in one call (bounds the size of the sampling grids)
+BATCH_SIZE = 16
+
+def reduce_image(image, factor):
+    #Mean over factor x factor blocks, the border which does not fill a whole block is dropped
+    height = image.shape[0] // factor * factor
+    width = image.shape[1] // factor * factor
+
+    blocks = image[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+class PatchExtractor:
+    #Cuts rotated square patches out of a mosaic.
+    #All patches of a batch are interpolated in a single map_coordinates call directly
+    #at the output resolution, instead of crop -> rotate -> crop -> resize per patch.
+
+    def __init__(self, image, edge_length_pixel, output_size=None, order=1):
+        self.edge_length_pixel = edge_length_pixel
+        self.output_size = output_size if output_size is not None else int(edge_length_pixel)
+        self.order = order
+
+        image = np.asarray(image, dtype=np.float32)
+
+        #Antialiasing: interpolate on a block averaged mosaic if patches are scaled down by 2x or more
+        scale = float(self.edge_length_pixel) / self.output_size
+        self.factor = max(int(scale), 1)
+        if self.factor > 1: image = reduce_image(image, self.factor)
+
+        #Spline coefficients are computed once and shared by all batches
+        if order > 1: image = ndimage.spline_filter(image, order=order, output=np.float32)
+
+        self.image = image
+
+        #Offsets of the output pixel centres from the patch centre (not rotated)
+        steps = (np.arange(self.output_size, dtype=np.float64) + 0.5) * scale - self.edge_length_pixel / 2.0
+        self.offset_y, self.offset_x = np.meshgrid(steps, steps, indexing='ij')
+
+    def get_grid(self, centers, angles):
+        #Angles are in degrees counter-clockwise (same as PIL rotate)
+        radians = -np.radians(np.asarray(angles, dtype=np.float64))[:, None, None]
+        cos, sin = np.cos(radians), np.sin(radians)
+
+        centers = np.asarray(centers, dtype=np.float64)
+        x = centers[:, 0, None, None] + cos * self.offset_x + sin * self.offset_y
+        y = centers[:, 1, None, None] - sin * self.offset_x + cos * self.offset_y
+
+        #Pixel centres are at integer coordinates for map_coordinates
+        return np.stack((y / self.factor - 0.5, x / self.factor - 0.5))
+
+    def extract(self, centers, angles):
+        grid = self.get_grid(centers, angles)
+
+        patches = ndimage.map_coordinates(self.image, grid, order=self.order, mode='nearest', prefilter=False, output=np.float32)
+        return patches
+
+    def iter_patches(self, centers, angles, batch_size=BATCH_SIZE):
+        for start in range(0, len(centers), batch_size):
+            patches = self.extract(centers[start:start + batch_size], angles[start:start + batch_size])
+            for patch in patches:
+                yield patch
+
+def to_uint8(patch):
+    return np.clip(np.rint(patch), 0, 255).astype(np.uint8)
+
+def to_uint16(patch):
+    #Patches of a float mosaic with heights normalized to [0,1]
+    return np.clip(np.rint(patch * 65535), 0, 65535).astype(np.uint16)
+
+def to_output(patch, bit_depth=8):
+    if bit_depth == 16: return to_uint16(patch)
+    return to_uint8(patch)
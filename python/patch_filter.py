@@ -0,0 +1,121 @@
+from collections import namedtuple
+
+import numpy as np
+
+from image_loader import normalize_image, NODATA_HEIGHT
+from strip_sampler import StripMosaic
+
+#Thresholds of the early rejection of sample footprints, None disables a threshold.
+#Heights in metres, max_nodata as a fraction of the footprint, replace draws new candidates for rejected ones.
+PatchFilter = namedtuple('PatchFilter', ['min_mean', 'min_std', 'max_nodata', 'replace'])
+
+#The statistics are computed on blocks, a footprint is at least this many blocks wide
+BLOCKS_PER_FOOTPRINT = 16
+
+def get_patch_filter(min_mean=None, min_std=None, max_nodata=None, replace=False):
+    if min_mean is None and min_std is None and max_nodata is None: return None
+    return PatchFilter(min_mean, min_std, max_nodata, replace)
+
+def get_block_size(edge_lengths_pixel):
+    return max(int(min(edge_lengths_pixel) // BLOCKS_PER_FOOTPRINT), 1)
+
+def get_integral_image(image):
+    #Summed-area table with a leading row and column of zeros:
+    #sum(image[y0:y1, x0:x1]) = table[y1,x1] - table[y0,x1] - table[y1,x0] + table[y0,x0]
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1), np.float64)
+    np.cumsum(image, axis=0, dtype=np.float64, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+
+    return table
+
+def get_block_sums(image, block_size, nodata_value=None, nodata_mask=None):
+    #Sums of the values, squared values and nodata pixels of block_size x block_size blocks (the last blocks can be smaller).
+    #Nodata pixels are the ones of nodata_mask if it is given, otherwise the ones equal to nodata_value.
+    #Strips of one block row keep the temporary arrays small.
+    height, width = image.shape
+    rows, cols = -(-height // block_size), -(-width // block_size)
+    col_starts = np.arange(0, width, block_size)
+
+    sums = np.zeros((rows, cols), np.float64)
+    squares = np.zeros((rows, cols), np.float64)
+    nodata = np.zeros((rows, cols), np.float64)
+
+    for row, start in enumerate(range(0, height, block_size)):
+        strip = image[start:start + block_size].astype(np.float64)
+
+        sums[row] = np.add.reduceat(strip.sum(axis=0), col_starts)
+        squares[row] = np.add.reduceat(np.square(strip).sum(axis=0), col_starts)
+        if nodata_mask is not None: nodata[row] = np.add.reduceat(nodata_mask[start:start + block_size].sum(axis=0), col_starts)
+        elif nodata_value is not None: nodata[row] = np.add.reduceat((strip == nodata_value).sum(axis=0), col_starts)
+
+    return sums, squares, nodata
+
+def get_mosaic_block_sums(image, block_size, nodata_value=None, nodata_mask=None):
+    #Block sums of a StripMosaic are computed strip by strip, every strip is a whole number of block rows
+    if not isinstance(image, StripMosaic): return get_block_sums(image, block_size, nodata_value, nodata_mask)
+
+    strips = [get_block_sums(strip, block_size, nodata_mask=mask) for _, strip, mask in image.iter_strips(block_size)]
+    return tuple(np.concatenate(sums, axis=0) for sums in zip(*strips))
+
+def get_nodata_value(min_height, max_height, bit_depth=8):
+    #Value of NODATA_HEIGHT in the normalized mosaic, None if the mosaic can not contain it
+    if not min_height <= NODATA_HEIGHT <= max_height: return None
+
+    return normalize_image(np.array([NODATA_HEIGHT], np.float32), min_height, max_height, bit_depth)[0]
+
+class FootprintStats:
+    #Mean and standard deviation (in metres) and nodata fraction of square sample footprints in O(1) per footprint.
+    #Summed-area tables are built once per mosaic over block sums, footprints are rounded to whole blocks.
+    #Rotation is ignored, the statistics are the ones of the unrotated square around the sample centre.
+    #Nodata pixels are the ones of nodata_mask (NODATA_HEIGHT before normalization, strips of a StripMosaic always
+    #have it), without it any pixel in the grey level of NODATA_HEIGHT.
+
+    def __init__(self, image, min_height, max_height, bit_depth=8, block_size=1, nodata_mask=None):
+        self.block_size = block_size
+        self.shape = image.shape
+
+        #Normalized values back to metres
+        self.offset = min_height
+        self.step = float(max_height - min_height) / (255 if bit_depth == 8 else 1)
+
+        sums, squares, nodata = get_mosaic_block_sums(image, block_size, get_nodata_value(min_height, max_height, bit_depth), nodata_mask)
+
+        self.sums = get_integral_image(sums)
+        self.squares = get_integral_image(squares)
+        self.nodata = get_integral_image(nodata)
+
+    def get_box_sums(self, table, y0, x0, y1, x1):
+        return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+    def get_stats(self, centers, edge_length_pixel):
+        #Centers as (x,y) pixels of the mosaic, returns arrays of means, standard deviations and nodata fractions
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        rows, cols = self.sums.shape[0] - 1, self.sums.shape[1] - 1
+
+        half = edge_length_pixel / 2.0
+        x0 = np.clip(np.rint((centers[:, 0] - half) / self.block_size), 0, cols - 1).astype(np.intp)
+        x1 = np.clip(np.rint((centers[:, 0] + half) / self.block_size), x0 + 1, cols).astype(np.intp)
+        y0 = np.clip(np.rint((centers[:, 1] - half) / self.block_size), 0, rows - 1).astype(np.intp)
+        y1 = np.clip(np.rint((centers[:, 1] + half) / self.block_size), y0 + 1, rows).astype(np.intp)
+
+        #Pixels of the footprints, the last row and column of blocks can be smaller
+        heights = np.minimum(y1 * self.block_size, self.shape[0]) - y0 * self.block_size
+        widths = np.minimum(x1 * self.block_size, self.shape[1]) - x0 * self.block_size
+        pixels = (heights * widths).astype(np.float64)
+
+        means = self.get_box_sums(self.sums, y0, x0, y1, x1) / pixels
+        variances = np.maximum(self.get_box_sums(self.squares, y0, x0, y1, x1) / pixels - np.square(means), 0)
+        nodata = self.get_box_sums(self.nodata, y0, x0, y1, x1) / pixels
+
+        return self.offset + means * self.step, np.sqrt(variances) * self.step, nodata
+
+def select_footprints(stats, centers, edge_length_pixel, patch_filter):
+    #Mask of the centers whose footprints pass all thresholds of the filter
+    means, stds, nodata = stats.get_stats(centers, edge_length_pixel)
+
+    mask = np.ones(len(means), dtype=bool)
+    if patch_filter.min_mean is not None: mask &= means >= patch_filter.min_mean
+    if patch_filter.min_std is not None: mask &= stds >= patch_filter.min_std
+    if patch_filter.max_nodata is not None: mask &= nodata <= patch_filter.max_nodata
+
+    return mask
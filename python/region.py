@@ -0,0 +1,113 @@
+import json
+import math
+
+from utilities import get_tile_area
+
+def parse_bbox(values):
+    #min_lon, min_lat, max_lon, max_lat, min_lon > max_lon crosses the antimeridian
+    min_lon, min_lat, max_lon, max_lat = [float(value) for value in values]
+
+    if min_lat > max_lat: raise ValueError("Bounding box with min_lat > max_lat: {}".format(values))
+
+    return min_lon, min_lat, max_lon, max_lat
+
+def load_polygons(path):
+    #Outer rings of all (multi) polygons of a GeoJSON file as lists of (lon, lat), holes are ignored
+    with open(path, 'r') as file:
+        data = json.load(file)
+
+    geometries = []
+    if data['type'] == 'FeatureCollection': geometries = [feature['geometry'] for feature in data['features']]
+    elif data['type'] == 'Feature': geometries = [data['geometry']]
+    else: geometries = [data]
+
+    polygons = []
+    for geometry in geometries:
+        if geometry['type'] == 'Polygon': polygons.append(geometry['coordinates'][0])
+        elif geometry['type'] == 'MultiPolygon': polygons += [polygon[0] for polygon in geometry['coordinates']]
+        else: raise ValueError("Unsupported geometry type: {}".format(geometry['type']))
+
+    return [[(float(point[0]), float(point[1])) for point in polygon] for polygon in polygons]
+
+def point_in_polygon(x, y, polygon):
+    #Even-odd rule
+    inside = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1): inside = not inside
+
+    return inside
+
+def segments_intersect(a, b, c, d):
+    def orientation(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    return orientation(a, b, c) * orientation(a, b, d) <= 0 and orientation(c, d, a) * orientation(c, d, b) <= 0
+
+def polygon_intersects_box(polygon, min_x, min_y, max_x, max_y):
+    corners = [(min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)]
+
+    if any(point_in_polygon(x, y, polygon) for x, y in corners): return True
+    if any(min_x <= x <= max_x and min_y <= y <= max_y for x, y in polygon): return True
+
+    box_edges = list(zip(corners, corners[1:] + corners[:1]))
+    for a, b in zip(polygon, polygon[1:] + polygon[:1]):
+        if any(segments_intersect(a, b, c, d) for c, d in box_edges): return True
+
+    return False
+
+class Region:
+    #Selects the 1x1 degree tiles (lower left corner latitude, longitude) which intersect a bounding box and/or polygons.
+    #Only positions are used, no raster has to be opened.
+
+    def __init__(self, bbox=None, polygons=None):
+        self.bbox = bbox
+        self.polygons = polygons
+
+    def intersects_bbox(self, latitude, longitude):
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+
+        if latitude + 1 <= min_lat or latitude >= max_lat: return False
+
+        if min_lon <= max_lon: return longitude + 1 > min_lon and longitude < max_lon
+
+        #Crosses the antimeridian
+        return longitude + 1 > min_lon or longitude < max_lon
+
+    def intersects_polygons(self, latitude, longitude):
+        return any(polygon_intersects_box(polygon, longitude, latitude, longitude + 1, latitude + 1) for polygon in self.polygons)
+
+    def contains_tile(self, latitude, longitude):
+        if self.bbox is not None and not self.intersects_bbox(latitude, longitude): return False
+        if self.polygons is not None and not self.intersects_polygons(latitude, longitude): return False
+
+        return True
+
+    def __call__(self, latitude, longitude):
+        return self.contains_tile(latitude, longitude)
+
+def get_region(bbox=None, polygon_path=None):
+    if bbox is None and polygon_path is None: return None
+
+    polygons = load_polygons(polygon_path) if polygon_path is not None else None
+    return Region(parse_bbox(bbox) if bbox is not None else None, polygons)
+
+def select_tiles(tiles, region=None):
+    if region is None: return list(tiles)
+    return [tile for tile in tiles if region.contains_tile(*tile)]
+
+def split_budget(tiles, total_samples):
+    #Samples per tile in proportion to the ground area of the tiles (largest remainder, the sum is exactly total_samples)
+    tiles = list(tiles)
+    if not tiles: return {}
+
+    areas = [get_tile_area(tile[0]) for tile in tiles]
+    total_area = sum(areas)
+
+    shares = [total_samples * area / total_area for area in areas]
+    budget = {tile: int(math.floor(share)) for tile, share in zip(tiles, shares)}
+
+    remainder = total_samples - sum(budget.values())
+    order = sorted(range(len(tiles)), key=lambda index: (-(shares[index] - math.floor(shares[index])), index))
+    for index in order[:remainder]: budget[tiles[index]] += 1
+
+    return budget
@@ -0,0 +1,343 @@
+import io
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.util import Finalize
+
+import numpy as np
+from PIL import Image
+
+from labels_writer import HEADER, parse_lines
+from metrics import stage, count, add_time
+
+OUTPUT_FORMATS = ['png', 'tar', 'npy']
+
+#Samples per shard
+SHARD_SIZE = 4096
+
+INDEX_HEADER = HEADER.rstrip('\n') + ';Offset;Size\n'
+
+#Codecs of the single samples (files and tar members), webp is lossless and only supports 8 bit
+CODECS = ['png', 'webp', 'tiff', 'npy']
+EXTENSIONS = {'png': '.png', 'webp': '.webp', 'tiff': '.tif', 'npy': '.npy'}
+
+def encode_png(patch, compress_level=None):
+    #compress_level None is the zlib default (6)
+    buffer = io.BytesIO()
+    if compress_level is None: Image.fromarray(patch).save(buffer, "PNG")
+    else: Image.fromarray(patch).save(buffer, "PNG", compress_level=compress_level)
+    return buffer.getvalue()
+
+def encode_patch(patch, codec='png', compress_level=None):
+    with stage('encode'):
+        if codec == 'png': return encode_png(patch, compress_level)
+
+        buffer = io.BytesIO()
+        if codec == 'webp': Image.fromarray(patch).save(buffer, "WEBP", lossless=True)
+        elif codec == 'tiff': Image.fromarray(patch).save(buffer, "TIFF")
+        elif codec == 'npy': np.save(buffer, patch)
+        else: raise ValueError("Unknown codec: {}".format(codec))
+
+        return buffer.getvalue()
+
+def decode_patch(data, file_name):
+    #The codec is given by the extension of the file name
+    if file_name.endswith('.npy'): return np.load(io.BytesIO(data))
+
+    image = Image.open(io.BytesIO(data))
+
+    #Lossless webp stores grayscale as RGB
+    if image.mode == 'RGB': image = image.convert('L')
+
+    return np.asarray(image)
+
+class EncodingPool:
+    #Encodes the patches of a writer in a thread pool (zlib and the image codecs release the GIL).
+    #The encoded samples are handed to the writer in the order of write, at most max_pending samples are in flight.
+    #The metrics of the tile belong to the sampling thread, so the encode time is measured in the pool and added in write_next.
+
+    def __init__(self, writer, threads, max_pending=None):
+        self.writer = writer
+        self.pool = ThreadPoolExecutor(threads)
+        self.max_pending = max_pending if max_pending is not None else 4 * threads
+        self.pending = deque()
+
+    def encode(self, patch):
+        start = time.perf_counter()
+        data = self.writer.encode(patch)
+        return data, time.perf_counter() - start
+
+    def write(self, file_name, patch, label):
+        future = self.pool.submit(self.encode, patch)
+        self.pending.append((file_name, patch, label, future))
+
+        while len(self.pending) > self.max_pending: self.write_next()
+
+    def write_next(self):
+        file_name, patch, label, future = self.pending.popleft()
+        data, elapsed = future.result()
+
+        add_time('encode', elapsed)
+        self.writer.write(file_name, patch, label, data)
+
+    def flush(self):
+        while self.pending: self.write_next()
+        self.writer.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+            self.writer.close()
+
+    @property
+    def extension(self):
+        return self.writer.extension
+
+class FileWriter:
+    #One file per sample (output_dir/<tile>/<sample>.png)
+
+    def __init__(self, output_dir, codec='png', compress_level=None):
+        self.output_dir = output_dir
+        self.codec = codec
+        self.compress_level = compress_level
+        self.extension = EXTENSIONS[codec]
+        self.created_dirs = set()
+
+    def encode(self, patch):
+        return encode_patch(patch, self.codec, self.compress_level)
+
+    def write(self, file_name, patch, label, data=None):
+        if data is None: data = self.encode(patch)
+        count('bytes_encoded', len(data))
+
+        path = os.path.join(self.output_dir, file_name)
+
+        current_output_dir = os.path.dirname(path)
+        if current_output_dir not in self.created_dirs:
+            os.makedirs(current_output_dir, exist_ok=True)
+            self.created_dirs.add(current_output_dir)
+
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class ShardWriter:
+    #Packs samples into shards of a fixed number of samples.
+    #Every shard gets an index file next to it with the labels and the offset and size of each sample.
+
+    shard_extension = None
+
+    #Extension of the file names of the samples
+    extension = '.png'
+
+    def __init__(self, output_dir, prefix, shard_size=SHARD_SIZE):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+
+        self.shard_id = 0
+        self.count = 0
+        self.index = None
+
+        if not os.path.exists(output_dir): os.makedirs(output_dir, exist_ok=True)
+
+    def get_shard_path(self, shard_id):
+        return os.path.join(self.output_dir, "{}-{:05d}.{}".format(self.prefix, shard_id, self.shard_extension))
+
+    def write(self, file_name, patch, label, data=None):
+        if self.index is not None and self.count >= self.shard_size:
+            self.close_shard()
+            self.shard_id += 1
+
+        if self.index is None:
+            #Never overwrite shards of an earlier run
+            while os.path.exists(self.get_shard_path(self.shard_id)): self.shard_id += 1
+
+            shard_path = self.get_shard_path(self.shard_id)
+            self.index = open(os.path.splitext(shard_path)[0] + '.csv', 'w')
+            self.index.write(INDEX_HEADER)
+            self.open_shard(shard_path, patch)
+            self.count = 0
+
+        offset, size = self.write_patch(file_name, patch, data)
+        self.index.write("{};{};{}\n".format(label.rstrip('\n'), offset, size))
+        self.count += 1
+
+    def flush(self):
+        if self.index is not None: self.index.flush()
+
+    def close(self):
+        if self.index is not None: self.close_shard()
+
+    def close_shard(self):
+        self.index.close()
+        self.index = None
+
+class TarShardWriter(ShardWriter):
+    #Shards are tar files of encoded samples (PNGs by default), offset and size point to the data inside the tar
+
+    shard_extension = 'tar'
+
+    def __init__(self, output_dir, prefix, shard_size=SHARD_SIZE, codec='png', compress_level=None):
+        super().__init__(output_dir, prefix, shard_size)
+        self.codec = codec
+        self.compress_level = compress_level
+        self.extension = EXTENSIONS[codec]
+
+    def encode(self, patch):
+        return encode_patch(patch, self.codec, self.compress_level)
+
+    def open_shard(self, shard_path, patch):
+        self.tar = tarfile.open(shard_path, 'w', format=tarfile.PAX_FORMAT)
+
+    def write_patch(self, file_name, patch, data=None):
+        if data is None: data = self.encode(patch)
+        count('bytes_encoded', len(data))
+
+        info = tarfile.TarInfo(file_name.replace(os.sep, '/'))
+        info.size = len(data)
+
+        offset = self.tar.offset + len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(info, io.BytesIO(data))
+
+        return offset, len(data)
+
+    def flush(self):
+        if self.index is not None: self.tar.fileobj.flush()
+        super().flush()
+
+    def close_shard(self):
+        self.tar.close()
+        super().close_shard()
+
+class NpyShardWriter(ShardWriter):
+    #Shards are raw .npy arrays of shape N x S x S, offset is the row of the sample
+
+    shard_extension = 'npy'
+
+    def open_shard(self, shard_path, patch):
+        self.shard_path = shard_path
+        self.array = np.lib.format.open_memmap(shard_path, 'w+', patch.dtype, (self.shard_size,) + patch.shape)
+
+    def write_patch(self, file_name, patch, data=None):
+        if patch.shape != self.array.shape[1:]:
+            raise ValueError("All samples of a npy shard need the same size, got {} and {}".format(patch.shape, self.array.shape[1:]))
+
+        self.array[self.count] = patch
+        return self.count, patch.nbytes
+
+    def flush(self):
+        if self.index is not None: self.array.flush()
+        super().flush()
+
+    def close_shard(self):
+        self.array.flush()
+        shape, dtype, offset = self.array.shape, self.array.dtype, self.array.offset
+        del self.array
+
+        if self.count < shape[0]: truncate_npy(self.shard_path, (self.count,) + shape[1:], dtype, offset)
+        super().close_shard()
+
+def truncate_npy(path, shape, dtype, data_offset):
+    #Shrink a partially filled shard to the rows which were written
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    header = header.getvalue()
+
+    data_size = int(np.prod(shape)) * dtype.itemsize
+
+    if len(header) == data_offset:
+        with open(path, 'r+b') as file:
+            file.write(header)
+            file.truncate(data_offset + data_size)
+        return
+
+    #Header size changed, copy the data behind a new header
+    data = np.load(path, mmap_mode='r')[:shape[0]]
+    np.save(path + '.tmp', np.ascontiguousarray(data))
+    del data
+    os.replace(path + '.tmp.npy', path)
+
+def get_sample_writer(output_dir, output_format='png', prefix='patches', shard_size=SHARD_SIZE, codec='png', compress_level=None, encode_threads=0):
+    #output_format png writes one file per sample in the given codec
+    if output_format == 'png': writer = FileWriter(output_dir, codec, compress_level)
+    elif output_format == 'tar': writer = TarShardWriter(output_dir, prefix, shard_size, codec, compress_level)
+    elif output_format == 'npy': return NpyShardWriter(output_dir, prefix, shard_size)
+    else: raise ValueError("Unknown output format: {}".format(output_format))
+
+    if encode_threads > 0: writer = EncodingPool(writer, encode_threads)
+
+    return writer
+
+#One writer per process and output directory, closed when the process exits
+process_writers = {}
+
+def get_process_writer(output_dir, output_format, shard_size=SHARD_SIZE, codec='png', compress_level=None, encode_threads=0):
+    if output_dir not in process_writers:
+        if not process_writers: Finalize(None, close_process_writer, exitpriority=10)
+
+        prefix = 'patches-{}'.format(os.getpid())
+        process_writers[output_dir] = get_sample_writer(output_dir, output_format, prefix, shard_size, codec, compress_level, encode_threads)
+
+    return process_writers[output_dir]
+
+def remove_shards(output_dir, prefix):
+    #Shards prefix-00000.tar (or .npy), prefix-00001.tar, ... and their indexes
+    shard_id = 0
+    while True:
+        paths = [os.path.join(output_dir, "{}-{:05d}.{}".format(prefix, shard_id, extension)) for extension in ('tar', 'npy', 'csv')]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths: return
+
+        for path in paths: os.remove(path)
+        shard_id += 1
+
+def get_tile_writer(output_dir, tile_prefix, output_format, shard_size=SHARD_SIZE, codec='png', compress_level=None, encode_threads=0):
+    #Packed samples of a tile go into shards of their own named after the tile (patches-<tile>-00000.tar), so the shards
+    #do not depend on the worker, the node or the other tiles. The writer has to be closed after the tile.
+    #Single files are written by the writer of the process.
+    if output_format == 'png': return get_process_writer(output_dir, output_format, shard_size, codec, compress_level, encode_threads)
+
+    #A tile which is processed again replaces its shards of an earlier run
+    remove_shards(output_dir, 'patches-' + tile_prefix)
+
+    return get_sample_writer(output_dir, output_format, 'patches-' + tile_prefix, shard_size, codec, compress_level, encode_threads)
+
+def close_process_writer():
+    for writer in process_writers.values(): writer.close()
+    process_writers.clear()
+
+def read_shard_index(shard_path):
+    with open(os.path.splitext(shard_path)[0] + '.csv', 'r') as file:
+        lines = file.readlines()[1:]
+
+    labels = parse_lines([line.rsplit(';', 2)[0] + '\n' for line in lines])
+    offsets = np.array([int(line.rsplit(';', 2)[1]) for line in lines], dtype=np.int64)
+    sizes = np.array([int(line.rsplit(';', 2)[2]) for line in lines], dtype=np.int64)
+
+    return labels, offsets, sizes
+
+def iter_shard(shard_path):
+    #Sequential read of all samples of a shard as (patch, label) pairs
+    labels, offsets, sizes = read_shard_index(shard_path)
+
+    if shard_path.endswith('.npy'):
+        patches = np.load(shard_path, mmap_mode='r')
+        for row, offset in enumerate(offsets):
+            yield patches[offset], {name: column[row] for name, column in labels.items()}
+        return
+
+    with open(shard_path, 'rb') as file:
+        for row, (offset, size) in enumerate(zip(offsets, sizes)):
+            file.seek(offset)
+            patch = decode_patch(file.read(size), labels['Filename'][row])
+            yield patch, {name: column[row] for name, column in labels.items()}
@@ -1,114 +1,357 @@
-from image_loader import get_image
-from PIL import Image, ImageDraw
+from image_loader import get_image, get_mosaic_layout, MosaicScale, get_decimation, get_preview, get_neighbourhood_paths, set_tile_cache, set_tile_catalog
+from catalog import get_catalog
+from tile_cache import TileCache
+from PIL import ImageDraw
 import numpy as np
 import os
-from utilities import stringify_latitude, stringify_longitude, string_to_position
-from utilities import pixel_to_coordinates, km_to_pixel
+from utilities import stringify_latitude, stringify_longitude
+from utilities import pixel_to_coordinates, km_to_pixel, build_projection_table
 from halton import halton
+from scheduler import sort_tiles, run_tiles, prefetch_iterator, get_chunks, parse_shard, select_shard, get_shard_suffix
+from patch_extractor import PatchExtractor, to_output
+from labels_writer import LabelsWriter, label_to_line, COLUMNS, get_shard_writer, close_shard_writer, SHARD_DIR
+from labels_writer import merge_shards, clear_shards, read_shards, read_label_lines, group_lines, write_labels
+from manifest import Manifest, get_params_hash, get_inputs
+from sample_writer import get_sample_writer, get_tile_writer, close_process_writer, OUTPUT_FORMATS, SHARD_SIZE, CODECS
+from metrics import stage, count, timed_iter, start_tile, suspend_tile, resume_tile, finish_tile, profile, set_profiling, close_profiler, MetricsWriter, STAGES
+from region import get_region, select_tiles, split_budget
+from source_sampler import SourceMosaic, SourceExtractor, get_source_image
+from strip_sampler import StripMosaic, StripExtractor, get_strip_image, get_strip_order, get_mosaic_bytes
+from patch_filter import FootprintStats, get_patch_filter, get_block_size, select_footprints
+from functools import partial
+from itertools import chain
+from collections import namedtuple
+from scipy.spatial import cKDTree
 import time
+import sys
 import argparse
 import random
-import math
 
-DEBUG = True
+DEBUG = False
 
-def sample_random_points(latitude, longitude,path_prefix, amount_samples, edge_length, output_dir=None,output_size=None):
-        
+#Rounds of replacement candidates for samples rejected by a patch filter
+REPLACE_ROUNDS = 4
+
+#mosaic: reproject the 3x3 neighbourhood and cut the samples from it, direct: read the samples from the source tiles
+ENGINES = ['mosaic', 'direct']
+
+#Samples per tile of a global sample budget, tiles which are not in it get the default amount
+tile_samples = None
+
+def set_tile_samples(budget):
+    global tile_samples
+    tile_samples = budget
+    
+def get_amount_samples(tile, default):
+    if tile_samples is None: return default
+    return tile_samples.get(tuple(tile), default)
+
+TileSamples = namedtuple('TileSamples', ['latitude', 'longitude', 'image', 'min_height', 'max_height', 'edge_length_pixel', 'points_pixel', 'points_lat_lon', 'angles', 'bit_depth', 'margin'])
+
+#Random streams of one tile: rotations (python random) and positions (numpy)
+TileRandom = namedtuple('TileRandom', ['rotations', 'positions'])
+
+#Edge length in km, output size in pixels (None: edge length in pixels) and amount of samples per tile of one scale
+Scale = namedtuple('Scale', ['edge_length', 'output_size', 'count'])
+
+def parse_scale(text):
+    #EDGE_LENGTH:OUTPUT_SIZE:COUNT, e.g. 10:256:150
+    edge_length, output_size, amount = text.split(':')
+    return Scale(float(edge_length), int(output_size) if output_size else None, int(amount))
+    
+def get_scale_dir(output_dir, scale):
+    name = '{:g}km'.format(scale.edge_length)
+    if scale.output_size is not None: name += '_{}px'.format(scale.output_size)
+    return os.path.join(output_dir, name)
+
+def check_engine(engine='mosaic', patch_filter=None):
+    if engine not in ENGINES: raise ValueError("Unknown engine: {}".format(engine))
+    if patch_filter is not None and engine == 'direct': raise ValueError("--engine direct has no mosaic for --min-mean-height, --min-height-std and --max-nodata")
+
+def prepare_tile(latitude, longitude, path_prefix, amount_samples, edge_length, min_spacing=None, bit_depth=8, patch_filter=None, engine='mosaic', seed=0, output_size=None, decimation=1, max_memory=None):
+    
+    tiles = prepare_scales(latitude, longitude, path_prefix, [Scale(edge_length, output_size, amount_samples)], min_spacing, bit_depth, patch_filter, engine, seed, decimation, max_memory)
+    if tiles is None: return None
+    
+    return tiles[0]
+    
+
+def prepare_scales(latitude, longitude, path_prefix, scales, min_spacing=None, bit_depth=8, patch_filter=None, engine='mosaic', seed=0, max_decimation=1, max_memory=None):
+    #The neighbourhood is loaded once with the margin of the largest scale, the samples of every scale are cut from it.
+    #With max_decimation > 1 the tiles are read at the lowest resolution (at most 1/max_decimation) which still
+    #has as many pixels per patch as the largest output size.
+    #A mosaic which needs more than max_memory bytes is assembled in strips while the samples are extracted.
+    
+    check_engine(engine, patch_filter)
+    
     #Calculate meters to pixel
-    edge_length_pixel = km_to_pixel(latitude,longitude, edge_length)
+    edge_lengths_pixel = [km_to_pixel(latitude,longitude, scale.edge_length) for scale in scales]
+    margin = max(edge_lengths_pixel)
+    
+    decimation = get_decimation(edge_lengths_pixel, [scale.output_size for scale in scales], max_decimation)
     
-    #TODO cache image
-    result = get_image(path_prefix, latitude, longitude, edge_length_pixel)
+    #Voids are counted on the heights before they are quantized
+    nodata_mask = patch_filter is not None and patch_filter.max_nodata is not None
+    
+    with stage('mosaic'):
+        if engine == 'direct': result = get_source_image(path_prefix, latitude, longitude, margin, bit_depth, decimation)
+        elif max_memory is not None and get_mosaic_bytes(latitude, longitude, margin, decimation) > max_memory:
+            result = get_strip_image(path_prefix, latitude, longitude, margin, bit_depth, decimation, max_memory)
+        else: result = get_image(path_prefix, latitude, longitude, margin, bit_depth, decimation, nodata_mask)
     if result is None: return None
     
-    image, min_height, max_height, placeholders = result
-        
-    file_prefix = stringify_latitude(latitude) + '_' + stringify_longitude(longitude)
-    current_output_dir = os.path.join(output_dir, file_prefix)
+    image, min_height, max_height, placeholders = result[:4]
+    nodata_mask = result[4] if len(result) > 4 else None
+    
+    #Samples are placed at full resolution and then moved into the (decimated) mosaic,
+    #the direct engine reads at reduced resolution on its own full resolution grid
+    mosaic_scale = MosaicScale(latitude, longitude, margin, decimation if engine == 'mosaic' else 1)
+    
+    image_shape = image.shape
+    if mosaic_scale.decimation > 1:
+        (top_margin, image_height, bottom_margin), width = get_mosaic_layout(latitude, longitude, margin)
+        image_shape = (top_margin + image_height + bottom_margin, width)
+    
+    #Summed-area tables of the mosaic are shared by all scales
+    footprints = None
+    if patch_filter is not None:
+        with stage('filter'):
+            footprints = FootprintStats(image, min_height, max_height, bit_depth, get_block_size([mosaic_scale.to_image_length(length) for length in edge_lengths_pixel]), nodata_mask)
     
-    if not os.path.exists(current_output_dir): os.makedirs(current_output_dir)
+    #All scales draw from the streams of the tile one after another
+    tile_random = get_tile_random(latitude, longitude, seed)
     
-    width, height = image.size
+    tiles = []
+    for scale, edge_length_pixel in zip(scales, edge_lengths_pixel):
+        with stage('points'):
+            points_pixel, points_lat_lon, angles = get_sample_points(latitude, longitude, image_shape, placeholders, scale.count, scale.edge_length, edge_length_pixel, min_spacing, margin, footprints, patch_filter, tile_random, mosaic_scale)
+            
+            points_pixel, image_edge_length = mosaic_scale.to_image(points_pixel), mosaic_scale.to_image_length(edge_length_pixel)
+            
+            #Samples are numbered in the order of the strips which are assembled one after another
+            if isinstance(image, StripMosaic):
+                order = get_strip_order(image, points_pixel, image_edge_length, scale.output_size)
+                points_pixel, points_lat_lon, angles = points_pixel[order], points_lat_lon[order], [angles[index] for index in order]
+            
+        tiles.append(TileSamples(latitude, longitude, image, min_height, max_height, image_edge_length, points_pixel, points_lat_lon, angles, bit_depth, mosaic_scale.image_offset))
     
-    content_width = width - 2*edge_length_pixel
-    content_height = height -2*edge_length_pixel
+    return tiles
     
-    radius_pixel = edge_length_pixel * 1.41421356237 #edge_length * sqrt(2)
+
+def get_sample_points(latitude, longitude, image_shape, placeholders, amount_samples, edge_length, edge_length_pixel, min_spacing=None, margin=None, footprints=None, patch_filter=None, tile_random=None, mosaic_scale=None):
     
-    points = equal_distribution(amount_samples, placeholders, edge_length_pixel, content_width, content_height)
+    #Without streams of the tile the global random state is used
+    if tile_random is None: tile_random = TileRandom(random, np.random)
     
-    points_lat_lon = pixel_to_coordinates(latitude,longitude, points)
+    #Width of the neighbourhood around the tile in the mosaic (can be larger than the samples)
+    if margin is None: margin = edge_length_pixel
+    
+    height, width = image_shape
     
-    margin = np.array([edge_length_pixel,edge_length_pixel])
+    content_width = width - 2*margin
+    content_height = height -2*margin
+    
+    #Minimum distance between sample centres from km to pixel
+    min_spacing_pixel = None
+    if min_spacing: min_spacing_pixel = min_spacing * edge_length_pixel / edge_length
+    
+    points = equal_distribution(amount_samples, placeholders, edge_length_pixel, content_width, content_height, min_spacing_pixel, tile_random.positions)
+    
+    #Flat, sea and placeholder footprints are rejected before anything is extracted
+    if patch_filter is not None:
+        with stage('filter'):
+            points = reject_points(points, footprints, patch_filter, placeholders, edge_length_pixel, margin, content_width, content_height, min_spacing_pixel, tile_random.positions, mosaic_scale)
+    
+    count('samples_accepted', len(points))
+    count('samples_rejected', amount_samples - len(points))
+    
+    points_lat_lon = pixel_to_coordinates(latitude,longitude, points)
     
     #Add Offset
-    points_pixel = np.add(points,margin)
+    points_pixel = np.add(points,np.array([margin,margin]))
     
-    for point_id, (x,y) in enumerate(points_pixel):
-        file_name = file_prefix+'_'+str(point_id) + ".png"
+    angles = [tile_random.rotations.uniform(0, 1)*360.0 for _ in points_pixel]
+    
+    return points_pixel, points_lat_lon, angles
+    
+
+def reject_points(points, footprints, patch_filter, placeholders, edge_length_pixel, margin, width, height, min_spacing=None, random_state=np.random, mosaic_scale=None):
+    #Drops the points whose footprint fails the thresholds of the filter. With patch_filter.replace the rejected points
+    #are replaced by uniformly drawn ones which pass, for a few rounds (mostly sea tiles keep fewer samples).
+    
+    #Footprints of points at full resolution in the (decimated) mosaic of the filter
+    def select(points):
+        if mosaic_scale is None: return select_footprints(footprints, points + margin, edge_length_pixel, patch_filter)
+        return select_footprints(footprints, mosaic_scale.to_image(points + margin), mosaic_scale.to_image_length(edge_length_pixel), patch_filter)
+    
+    target = len(points)
+    
+    points = points[select(points)]
+    count('samples_filtered', target - len(points))
+    
+    for _ in range(REPLACE_ROUNDS if patch_filter.replace else 0):
+        missing = target - len(points)
+        if missing <= 0: break
+        
+        candidates = random_distribution(missing * 2, placeholders, edge_length_pixel, width, height, random_state)
+        candidates = candidates[select(candidates)]
+        
+        #Earlier points are kept first by the spacing
+        points = np.concatenate((points, candidates), axis=0)
+        if min_spacing: points = points[select_points_with_spacing(points, min_spacing)]
         
-        angle = random.uniform(0, 1)*360.0
+        points = points[:target]
+        
+    return points
     
-        with open(os.path.join(output_dir,'labels.csv'), 'a') as file:
-            lat, lon  = points_lat_lon[point_id][0], points_lat_lon[point_id][1]
-            path = os.path.join(file_prefix,file_name)
-            
-            csv_line = "{};{};{};{};{};{}\n".format(path,lat,lon,angle,min_height,max_height)
-            file.write(csv_line)
+
+def get_extractor(image, edge_length_pixel, output_size=None):
+    if isinstance(image, SourceMosaic): return SourceExtractor(image, edge_length_pixel, output_size)
+    if isinstance(image, StripMosaic): return StripExtractor(image, edge_length_pixel, output_size)
+    return PatchExtractor(image, edge_length_pixel, output_size)
     
-        point1 = (x - radius_pixel/2,y-radius_pixel/2)
-        point2 = (x + radius_pixel/2,y+radius_pixel/2)
+
+def iter_tile_samples(tile, output_size=None, extension='.png'):
+    
+    file_prefix = get_tile_prefix((tile.latitude, tile.longitude))
+    
+    extractor = get_extractor(tile.image, tile.edge_length_pixel, output_size)
+    patches = extractor.iter_patches(tile.points_pixel, tile.angles)
+    
+    for point_id, patch in enumerate(patches):
+        file_name = file_prefix+'_'+str(point_id) + extension
         
-        image_slice = image.crop((point1[0],point1[1],point2[0],point2[1]))
-        image_slice = image_slice.rotate(angle,resample=Image.BICUBIC)
+        lat, lon  = tile.points_lat_lon[point_id][0], tile.points_lat_lon[point_id][1]
+        path = os.path.join(file_prefix,file_name)
         
-        slice_width, slice_height = image_slice.size
+        label = dict(zip(COLUMNS, (path, lat, lon, tile.angles[point_id], tile.min_height, tile.max_height)))
         
-        margin = int((slice_width-edge_length_pixel)/2)
+        yield to_output(patch, tile.bit_depth), label
         
-        slice_bounding_box = (margin,margin,slice_width-margin,slice_height-margin)
+
+def get_bounding_box(tile):
+    height, width = tile.image.shape
+    return [(tile.margin,tile.margin),(width-tile.margin,height-tile.margin)]
+    
+
+def sample_random_points(latitude, longitude,path_prefix, amount_samples, edge_length, output_dir=None,output_size=None, labels=None, sample_writer=None, min_spacing=None, bit_depth=8, scales=None, patch_filter=None, engine='mosaic', seed=0, decimation=1, max_memory=None):
+    #With a list of scales (edge_length, output_size, count) every scale is written into its own sub directory
+    #of output_dir with its own labels file, labels and sample_writer are then lists with one writer per scale.
+    #Returns one result per scale.
+    
+    if scales is None:
+        tile = prepare_tile(latitude, longitude, path_prefix, amount_samples, edge_length, min_spacing, bit_depth, patch_filter, engine, seed, output_size, decimation, max_memory)
+        if tile is None: return None
         
-        image_slice = image_slice.crop(slice_bounding_box)
-        if output_size is not None: image_slice = image_slice.resize([output_size,output_size],Image.ANTIALIAS)
+        return write_tile_samples(tile, output_dir, output_size, labels, sample_writer)
         
-        image_slice.save(os.path.join(current_output_dir,file_name),"PNG")
+    tiles = prepare_scales(latitude, longitude, path_prefix, scales, min_spacing, bit_depth, patch_filter, engine, seed, decimation, max_memory)
+    if tiles is None: return None
+    
+    results = []
+    for index, (tile, scale) in enumerate(zip(tiles, scales)):
+        scale_dir = get_scale_dir(output_dir, scale)
+        if not os.path.exists(scale_dir): os.makedirs(scale_dir, exist_ok=True)
         
+        scale_labels = labels[index] if labels is not None else None
+        scale_writer = sample_writer[index] if sample_writer is not None else None
+        
+        results.append(write_tile_samples(tile, scale_dir, scale.output_size, scale_labels, scale_writer))
+        
+    return results
+    
+
+def write_tile_samples(tile, output_dir=None, output_size=None, labels=None, sample_writer=None):
+    
+    #Without a writer of the caller the labels file is opened once per tile
+    labels_writer = labels
+    if labels_writer is None: labels_writer = LabelsWriter(os.path.join(output_dir,'labels.csv'))
+    
+    writer = sample_writer
+    if writer is None: writer = get_sample_writer(output_dir)
+    
+    for patch, label in timed_iter(iter_tile_samples(tile, output_size, writer.extension), 'extraction'):
+        
+        with stage('labels'):
+            line = label_to_line(label)
+            labels_writer.write_lines([line])
+        
+        with stage('write'):
+            writer.write(label['Filename'], patch, line)
+        
+    if labels is None: labels_writer.close()
+    else: labels_writer.flush()
+    
+    writer.flush()
         
-    bounding_box = [(edge_length_pixel,edge_length_pixel),(width-edge_length_pixel,height-edge_length_pixel)]
-    return image, points_pixel, bounding_box
+    return tile.image, tile.points_pixel, get_bounding_box(tile)
+    
+
+def iter_samples(input_dir, edge_length, samples_per_tile, output_size=None, seed=0, prefetch=0, tiles=None, min_spacing=None, catalog=None, bit_depth=8, region=None, patch_filter=None, engine='mosaic', decimation=1, max_memory=None):
+    #Yields (patch, label) pairs tile by tile without writing anything to disk.
+    #Only the current tile (plus up to prefetch tiles loaded in a background thread) is held in memory.
+    check_engine(engine, patch_filter)
+    
+    if catalog is None: catalog = get_catalog(input_dir, stats=needs_tile_stats(engine, max_memory), tile_filter=region)
+    set_tile_catalog(catalog)
+    
+    if tiles is None: tiles = sort_tiles(select_tiles(catalog.get_tiles(), region))
+    
+    def load(tile):
+        return prepare_tile(tile[0], tile[1], input_dir, samples_per_tile, edge_length, min_spacing, bit_depth, patch_filter, engine, seed, output_size, decimation, max_memory)
+    
+    prepared_tiles = (load(tile) for tile in tiles)
+    if prefetch > 0: prepared_tiles = prefetch_iterator(prepared_tiles, prefetch)
+    
+    for tile in prepared_tiles:
+        if tile is None: continue
+        
+        for sample in iter_tile_samples(tile, output_size):
+            yield sample
     
 
 def select_points_with_distance(input_points, distance_points,min_distance):
     
-    mask = []
+    input_points = np.asarray(input_points, dtype=np.float64).reshape(-1, 2)
+    
+    if len(distance_points) == 0 or len(input_points) == 0: return np.ones(len(input_points), dtype=bool)
     
-    for input_point in input_points:
-        min_distance_ok = True
-        for distance_point in distance_points:
-            distance = math.hypot(distance_point[0] - input_point[0], distance_point[1] - input_point[1])
-            if distance < min_distance:
-                min_distance_ok= False
-                break
-        mask.append(min_distance_ok)
+    #Distance of every point to its closest distance point
+    distances, _ = cKDTree(np.asarray(distance_points, dtype=np.float64)).query(input_points)
         
-    return mask
+    return distances >= min_distance
     
     
-def equal_distribution(points, placeholders, offset, width, height):
+def select_points_with_spacing(points, min_spacing):
+    #Greedy poisson disk thinning: a point is kept if no earlier kept point is closer than min_spacing
     
-    aspect = float(height)/width
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    mask = np.ones(len(points), dtype=bool)
+    
+    if len(points) < 2 or not min_spacing: return mask
+    
+    pairs = cKDTree(points).query_pairs(min_spacing, output_type='ndarray')
+    if len(pairs) == 0: return mask
+    
+    #Pairs are (i,j) with i < j, grouped by i
+    pairs = pairs[np.argsort(pairs[:,0], kind='stable')]
+    starts = np.searchsorted(pairs[:,0], np.arange(len(points)+1))
+    
+    for i in np.unique(pairs[:,0]):
+        if mask[i]: mask[pairs[starts[i]:starts[i+1],1]] = False
         
-    halton_size = int(points*0.8)
-    random_size = points-halton_size
+    return mask
     
-    halton_points = halton(2, halton_size)
-    random_points = np.random.rand(random_size, 2)
     
-    points = np.concatenate((halton_points,random_points), axis=0)
+def random_distribution(points, placeholders, offset, width, height, random_state=np.random):
+    #Uniformly distributed points, used to replace rejected samples
     
-    points = np.multiply(points, np.array([width*aspect,height]).T)
+    points = np.multiply(random_state.rand(points, 2), np.array([width,height]))
     
-    points = points[points[:,0] <= width]
+    return select_placeholder_points(points, placeholders, offset, width, height)
+    
+    
+def select_placeholder_points(points, placeholders, offset, width, height):
     
     #Pay attention to parts of the image which are filled with placeholders
     
@@ -141,22 +384,41 @@ def equal_distribution(points, placeholders, offset, width, height):
     if len(points_to_keep_distance) > 0:
         mask = select_points_with_distance(points, points_to_keep_distance,offset)
         points = points[mask]
+        
+    return points
+    
+    
+def equal_distribution(points, placeholders, offset, width, height, min_spacing=None, random_state=np.random):
+    
+    aspect = float(height)/width
+        
+    halton_size = int(points*0.8)
+    random_size = points-halton_size
+    
+    halton_points = halton(2, halton_size)
+    random_points = random_state.rand(random_size, 2)
+    
+    points = np.concatenate((halton_points,random_points), axis=0)
+    
+    points = np.multiply(points, np.array([width*aspect,height]).T)
+    
+    points = points[points[:,0] <= width]
+    
+    points = select_placeholder_points(points, placeholders, offset, width, height)
+        
+    if min_spacing:
+        points = points[select_points_with_spacing(points, min_spacing)]
     
     return points
 
 
-def get_patch_list():
-    patch_list = []
-    for folder in os.listdir(PATH_TO_DATASET):
-        if not folder.startswith("."):
-            for file in os.listdir(os.path.join(PATH_TO_DATASET,folder)):
-                if file.endswith("DSM.tif") and not file.startswith("."):
-                    patch_list.append(file)
-                    
-    return patch_list
+def get_patch_list(path_to_dataset):
+    catalog = get_catalog(path_to_dataset)
+    return [os.path.basename(catalog.get(*tile)['path']) for tile in catalog.get_tiles()]
     
     
-def show_debug_draw(image, points, bounding_box):
+def show_debug_draw(image, points, bounding_box, bit_depth=8):
+    image = get_preview(image, bit_depth)
     draw = ImageDraw.Draw(image)
     line_color = 255
     
@@ -172,65 +434,316 @@ def show_debug_draw(image, points, bounding_box):
     image.show()
         
 
-def run_sampler(output_size,output_dir,samples_per_patch, sample_edge_length):
+def get_tile_random(latitude, longitude, seed=0):
+    #Every tile gets its own random streams derived from its position, so results do not depend on
+    #the processing order, the worker, the thread or the node which processes the tile
+    tile_seed = seed * 64800 + (int(latitude) + 90) * 360 + (int(longitude) + 180)
     
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    #Reset labels
-    with open(os.path.join(output_dir,'labels.csv'), 'a') as file:
-        file.truncate(0)
-        file.write('Filename;Latitude;Longitude;Rotation;MinHeight;MaxHeight\n')
-        
-    all_patches = get_patch_list()
+    return TileRandom(random.Random(tile_seed), np.random.RandomState(tile_seed % 2**32))
     
-    patch_size = len(all_patches)
+
+def process_tile(tile, input_dir, samples_per_patch, sample_edge_length, output_dir, output_size, seed=0, debug=False, output_format='png', shard_size=SHARD_SIZE, min_spacing=None, bit_depth=8, codec='png', compress_level=None, encode_threads=0, scales=None, patch_filter=None, engine='mosaic', shard=None, decimation=1, max_memory=None):
+    #Returns the number of samples (None if the tile does not exist) and the metrics of the tile
+    _, prepared, metrics = load_tile(tile, input_dir, samples_per_patch, sample_edge_length, seed, min_spacing, bit_depth, scales, patch_filter, engine, output_size, decimation, max_memory)
     
-    start = time.time()
+    return write_tile(prepared, metrics, output_dir, output_size, debug, output_format, shard_size, codec, compress_level, encode_threads, scales, shard)
     
-    for current_patch, patch in enumerate(all_patches):
-        lat, lon = string_to_position(patch)
-        
-        image, points, bounding_box = sample_random_points(lat,lon, amount_samples=samples_per_patch, edge_length=sample_edge_length,output_dir=output_dir, output_size=output_size)
+    
+def load_tile(tile, input_dir, samples_per_patch, sample_edge_length, seed=0, min_spacing=None, bit_depth=8, scales=None, patch_filter=None, engine='mosaic', output_size=None, decimation=1, max_memory=None):
+    #Reads and reprojects the neighbourhood and places the samples, the metrics of the tile are handed to write_tile
+    start_tile(get_tile_prefix(tile))
+    
+    if scales is None: scales = [Scale(sample_edge_length, output_size, get_amount_samples(tile, samples_per_patch))]
+    
+    with profile('tile'):
+        prepared = prepare_scales(tile[0], tile[1], input_dir, scales, min_spacing, bit_depth, patch_filter, engine, seed, decimation, max_memory)
         
-        if DEBUG: show_debug_draw(image,points,bounding_box)
+    return tile, prepared, suspend_tile()
+    
+    
+def get_scale_outputs(output_dir, output_size, scales=None):
+    #Output directory and size of every scale, a single scale is written directly into output_dir
+    if scales is None: return [(output_dir, output_size)]
+    return [(get_scale_dir(output_dir, scale), scale.output_size) for scale in scales]
+    
+    
+def write_tile(prepared, metrics, output_dir, output_size, debug=False, output_format='png', shard_size=SHARD_SIZE, codec='png', compress_level=None, encode_threads=0, scales=None, shard=None):
+    resume_tile(metrics)
+    
+    samples = None
+    with profile('tile'):
+        if prepared is not None:
+            samples = 0
             
-        end = time.time()
+            for tile, (scale_dir, scale_size) in zip(prepared, get_scale_outputs(output_dir, output_size, scales)):
+                #Every process appends to its own shard, shards are merged after all tiles are done
+                labels = get_shard_writer(get_labels_shard_dir(scale_dir, shard))
+                
+                sample_writer = get_tile_writer(scale_dir, get_tile_prefix((tile.latitude, tile.longitude)), output_format, shard_size, codec, compress_level, encode_threads)
+                
+                result = write_tile_samples(tile, scale_dir, scale_size, labels, sample_writer)
+                if output_format != 'png': sample_writer.close()
+                
+                #Only a reprojected mosaic can be drawn
+                if debug and isinstance(tile.image, np.ndarray): show_debug_draw(*result, bit_depth=tile.bit_depth)
+                
+                samples += len(result[1])
+            
+    return samples, finish_tile()
+    
+    
+def iter_processed_tiles(tiles, input_dir, samples_per_patch, sample_edge_length, output_dir, output_size, seed=0, debug=False, output_format='png', shard_size=SHARD_SIZE, min_spacing=None, bit_depth=8, codec='png', compress_level=None, encode_threads=0, scales=None, patch_filter=None, engine='mosaic', shard=None, decimation=1, max_memory=None, prefetch=1):
+    #Pipelined process_tile: the next prefetch tiles are loaded in a background thread while the current one is sampled and written.
+    #The bounded queue of prefetch_iterator keeps at most prefetch + 2 mosaics in memory.
+    load = partial(load_tile, input_dir=input_dir, samples_per_patch=samples_per_patch, sample_edge_length=sample_edge_length, seed=seed, min_spacing=min_spacing, bit_depth=bit_depth, scales=scales, patch_filter=patch_filter, engine=engine, output_size=output_size, decimation=decimation, max_memory=max_memory)
+    
+    for tile, prepared, metrics in prefetch_iterator(map(load, tiles), prefetch):
+        yield write_tile(prepared, metrics, output_dir, output_size, debug, output_format, shard_size, codec, compress_level, encode_threads, scales, shard)
         
-        total_time = end - start
-        avg_time = total_time/current_patch
         
-        output_info = "\n{}/{} - total:{:0.2f}s avg:{:0.2f}s \n".format(current_patch+1, patch_size, total_time,avg_time)
-        print(output_info)
+def process_tiles(tiles, **kwargs):
+    #A chunk of consecutive tiles is pipelined by one worker
+    return list(iter_processed_tiles(tiles, **kwargs))
+    
+    
+def init_worker(cache_dir, cache_size, catalog=None, profile_stages=None, profile_dir=None, budget=None):
+    if cache_dir is not None: set_tile_cache(TileCache(cache_dir, cache_size))
+    set_tile_catalog(catalog)
+    set_tile_samples(budget)
+    set_profiling(profile_stages, profile_dir)
     
-#run_sampler(output_size=256,output_dir='../samples', samples_per_patch=150, sample_edge_length=10)
 
-# Initiate the parser
-parser = argparse.ArgumentParser()
+def needs_tile_stats(engine='mosaic', max_memory=None):
+    #Only the direct engine and the strips of max_memory take the height range from the catalog
+    return engine == 'direct' or max_memory is not None
+    
 
-# Add long and short argument
-parser.add_argument("input_dir")
-parser.add_argument("edge_length",type=float)
-parser.add_argument("amount_samples", type=int)
-parser.add_argument("--debug", "-d", help="run in debug mode", default=False, type=bool)
-parser.add_argument("--size", "-s", help="set the output size", default=None, type=int)
-parser.add_argument("--output", "-o", help="set the output directory path", default="../output")
+def get_tile_prefix(tile):
+    return stringify_latitude(tile[0]) + '_' + stringify_longitude(tile[1])
+    
 
-# Read arguments from the command line
-args = parser.parse_args()
+def get_labels_path(output_dir, labels_format='csv', shard=None):
+    labels_name = 'labels' + get_shard_suffix(shard) + ('.npz' if labels_format == 'npz' else '.csv')
+    return os.path.join(output_dir, labels_name)
+    
 
-input_dir = args.input_dir
-edge_length = args.edge_length
-amount_samples = args.amount_samples
+def get_labels_shard_dir(output_dir, shard=None):
+    #Every node merges only its own shards
+    return os.path.join(output_dir, SHARD_DIR + get_shard_suffix(shard))
+    
 
-output_dir = args.output
-output_size = args.size
-DEBUG = args.debug
+def load_previous_labels(output_dir, shard_dir, labels_format, tiles, shard=None):
+    #Labels of finished tiles from the last run (including shards left over by a crash)
+    previous = {}
+    
+    for current_format in ['npz', 'csv'] if labels_format == 'csv' else ['csv', 'npz']:
+        labels_path = get_labels_path(output_dir, current_format, shard)
+        if os.path.exists(labels_path): previous.update(group_lines(read_label_lines(labels_path)))
+        
+    previous.update(read_shards(shard_dir))
+    clear_shards(shard_dir)
+    
+    return {tile: lines for tile, lines in previous.items() if tile in tiles}
+    
 
-data = sample_random_points(53, 6, input_dir,amount_samples, edge_length, output_dir=output_dir,output_size=output_size)
-if data is not None and DEBUG: show_debug_draw(*data)
-else: print("No data")
+def run_sampler(input_dir, output_size,output_dir,samples_per_patch, sample_edge_length, workers=1, seed=0, cache_dir=None, cache_size=None, labels_format='csv', output_format='png', shard_size=SHARD_SIZE, min_spacing=None, restart=False, catalog=None, bit_depth=8, metrics_path=None, profile_stages=None, profile_dir=None, prefetch=0, codec='png', compress_level=None, encode_threads=0, region=None, total_samples=None, scales=None, patch_filter=None, engine='mosaic', shard=None, decimation=1, max_memory=None):
+    
+    check_engine(engine, patch_filter)
+    
+    #Every scale is written into its own directory with its own labels
+    scale_dirs = [output_dir] if scales is None else [get_scale_dir(output_dir, scale) for scale in scales]
+    
+    for scale_dir in [output_dir] + scale_dirs:
+        if not os.path.exists(scale_dir):
+            os.makedirs(scale_dir)
+        
+    #All existence and neighbour lookups go through the catalog
+    if catalog is None: catalog = get_catalog(input_dir, stats=needs_tile_stats(engine, max_memory), tile_filter=region, fallback_dir=output_dir)
+    set_tile_catalog(catalog)
+    
+    #Tiles are selected by their position only, before any raster is opened
+    all_patches = sort_tiles(select_tiles(catalog.get_tiles(), region))
+    
+    #A global budget is split across the tiles in proportion to their ground area
+    budget = split_budget(all_patches, total_samples) if total_samples is not None else None
+    set_tile_samples(budget)
+    
+    #With shard i/N this node only processes its contiguous part of the tiles, the budget is still split across all tiles
+    all_patches = select_shard(all_patches, shard)
+    
+    #Tiles without samples in the budget are never read
+    if budget is not None: all_patches = [tile for tile in all_patches if budget[tile] > 0]
+    
+    #Skip tiles which were completed by an earlier run with the same parameters and inputs
+    manifest = Manifest(output_dir, 'manifest{}.jsonl'.format(get_shard_suffix(shard)))
+    if restart: manifest.reset()
+    
+    params = {'edge_length': sample_edge_length, 'samples': samples_per_patch, 'output_size': output_size, 'seed': seed,
+        'min_spacing': min_spacing, 'output_format': output_format, 'bit_depth': bit_depth, 'codec': codec, 'compress_level': compress_level}
+    if scales is not None: params['scales'] = [list(scale) for scale in scales]
+    if patch_filter is not None: params['patch_filter'] = list(patch_filter)
+    if engine != 'mosaic': params['engine'] = engine
+    if decimation > 1: params['decimation'] = decimation
+    if max_memory is not None: params['max_memory'] = max_memory
+    
+    #With a budget the amount of samples differs per tile, so only tiles whose share changed are processed again
+    params_hashes = {tile: get_params_hash(dict(params, samples=get_amount_samples(tile, samples_per_patch))) for tile in all_patches}
+    
+    inputs = {tile: get_inputs(input_dir, get_neighbourhood_paths(input_dir, *tile), catalog) for tile in all_patches}
+    
+    pending_patches = [tile for tile in all_patches if not manifest.is_complete(get_tile_prefix(tile), params_hashes[tile], inputs[tile])]
+    
+    finished = set(get_tile_prefix(tile) for tile in all_patches) - set(get_tile_prefix(tile) for tile in pending_patches)
+    previous_labels = [load_previous_labels(scale_dir, get_labels_shard_dir(scale_dir, shard), labels_format, finished, shard) for scale_dir in scale_dirs]
+    
+    print("{} of {} tiles already done".format(len(all_patches) - len(pending_patches), len(all_patches)))
+    
+    patch_size = len(pending_patches)
+    
+    #Built once before the workers are started
+    build_projection_table()
     
+    tile_args = dict(input_dir=input_dir, samples_per_patch=samples_per_patch, sample_edge_length=sample_edge_length,
+        output_dir=output_dir, output_size=output_size, seed=seed, debug=DEBUG and workers <= 1, output_format=output_format, shard_size=shard_size, min_spacing=min_spacing, bit_depth=bit_depth,
+        codec=codec, compress_level=compress_level, encode_threads=encode_threads, scales=scales, patch_filter=patch_filter, engine=engine, shard=shard, decimation=decimation, max_memory=max_memory)
     
+    #Per tile stage timings and counters, optionally as json lines
+    metrics = MetricsWriter(metrics_path)
+    
+    if profile_stages and profile_dir is None: profile_dir = os.path.join(output_dir, 'profiles')
+    set_profiling(profile_stages, profile_dir)
+    
+    start = time.time()
+    
+    initargs = (cache_dir, cache_size, catalog, profile_stages, profile_dir, budget)
+    
+    if prefetch <= 0:
+        results = run_tiles(partial(process_tile, **tile_args), pending_patches, workers=workers, initializer=init_worker, initargs=initargs)
+    elif workers <= 1:
+        results = iter_processed_tiles(pending_patches, prefetch=prefetch, **tile_args)
+    else:
+        #Every worker pipelines chunks of consecutive tiles
+        chunks = get_chunks(pending_patches, workers)
+        results = chain.from_iterable(run_tiles(partial(process_tiles, prefetch=prefetch, **tile_args), chunks, workers=workers, chunksize=1, initializer=init_worker, initargs=initargs))
+    
+    for current_patch, (tile, (samples, record)) in enumerate(zip(pending_patches, results)):
+        
+        if samples is not None: manifest.record(get_tile_prefix(tile), params_hashes[tile], inputs[tile], samples)
+        metrics.write(record)
+            
+        end = time.time()
+        
+        total_time = end - start
+        avg_time = total_time/(current_patch+1)
+        
+        output_info = "{}/{} {} - samples:{} total:{:0.2f}s avg:{:0.2f}s".format(current_patch+1, patch_size, get_tile_prefix(tile), samples, total_time,avg_time)
+        print(output_info)
+        
+    close_shard_writer()
+    close_process_writer()
+    close_profiler()
+    
+    metrics.close()
+    print('\n' + metrics.get_summary())
+    
+    for scale_dir, scale_labels in zip(scale_dirs, previous_labels):
+        merge_shards(get_labels_shard_dir(scale_dir, shard), get_labels_path(scale_dir, labels_format, shard), [get_tile_prefix(tile) for tile in all_patches], labels_format, scale_labels)
+        
 
+def merge_sharded_labels(output_dir, count, labels_format='csv', scales=None):
+    #Labels of the shards 0/count ... count-1/count are concatenated in shard order, which is the
+    #tile order of an unsharded run
+    scale_dirs = [output_dir] if scales is None else [get_scale_dir(output_dir, scale) for scale in scales]
+    
+    for scale_dir in scale_dirs:
+        paths = [get_labels_path(scale_dir, labels_format, (index, count)) for index in range(count)]
+        
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing: raise FileNotFoundError("Labels of unfinished shards: {}".format(', '.join(missing)))
+        
+        lines = [line for path in paths for line in read_label_lines(path)]
+        tiles = group_lines(lines)
+        
+        write_labels(get_labels_path(scale_dir, labels_format), tiles, list(tiles), labels_format)
+    
 
+if __name__ == '__main__':
+    
+    # Initiate the parser
+    parser = argparse.ArgumentParser()
+    
+    # Add long and short argument
+    parser.add_argument("input_dir")
+    parser.add_argument("edge_length",type=float)
+    parser.add_argument("amount_samples", type=int)
+    parser.add_argument("--debug", "-d", help="run in debug mode", default=False, type=bool)
+    parser.add_argument("--size", "-s", help="set the output size", default=None, type=int)
+    parser.add_argument("--output", "-o", help="set the output directory path", default="../output")
+    parser.add_argument("--cache-dir", help="cache reprojected tiles in this directory", default=None)
+    parser.add_argument("--cache-size", help="maximum size of the tile cache in GB", default=8, type=float)
+    parser.add_argument("--workers", "-w", help="number of worker processes", default=1, type=int)
+    parser.add_argument("--seed", help="seed of the random sample positions and rotations", default=0, type=int)
+    parser.add_argument("--labels-format", help="format of the labels file", default="csv", choices=["csv", "npz"])
+    parser.add_argument("--output-format", help="write one png per sample or pack samples into shards", default="png", choices=OUTPUT_FORMATS)
+    parser.add_argument("--shard-size", help="number of samples per shard", default=SHARD_SIZE, type=int)
+    parser.add_argument("--bit-depth", help="bit depth of the output patches, 16 keeps the mosaic in float32 and writes I;16 patches", default=8, type=int, choices=[8, 16])
+    parser.add_argument("--catalog", help="path of the tile catalog (default: catalog.json in the input directory)", default=None)
+    parser.add_argument("--rescan", help="scan all tiles of the input directory again", action="store_true")
+    parser.add_argument("--restart", help="process all tiles again instead of skipping the ones finished by an earlier run", action="store_true")
+    parser.add_argument("--codec", help="codec of the samples of the png (one file per sample) and tar output formats", default="png", choices=CODECS)
+    parser.add_argument("--compress-level", help="zlib compression level of png samples (0-9, default: 6)", default=None, type=int, choices=range(10))
+    parser.add_argument("--encode-threads", help="encode the samples in this many threads per process (0: encode in the sampling thread)", default=0, type=int)
+    parser.add_argument("--prefetch", help="load the next tiles in a background thread while the current tile is sampled (0: off)", default=0, type=int)
+    parser.add_argument("--metrics", help="append the stage timings and counters of every tile as json lines to this file", default=None)
+    parser.add_argument("--profile", help="run these stages under cProfile ('tile' for everything)", default=None, nargs='+', choices=STAGES + ['tile'])
+    parser.add_argument("--profile-dir", help="directory of the profiles (default: profiles in the output directory)", default=None)
+    parser.add_argument("--bbox", help="only sample the tiles which intersect this bounding box", default=None, type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument("--polygon", help="only sample the tiles which intersect the polygons of this GeoJSON file", default=None)
+    parser.add_argument("--total-samples", help="split this many samples across all tiles in proportion to their ground area instead of amount_samples per tile", default=None, type=int)
+    parser.add_argument("--scales", help="sample several scales from the same mosaic, each as EDGE_KM:SIZE:COUNT (SIZE may be empty), overrides edge_length, amount_samples and --size", default=None, type=parse_scale, nargs='+', metavar='EDGE:SIZE:COUNT')
+    parser.add_argument("--engine", help="mosaic: reproject the neighbourhood of every tile, direct: read only the source pixels under the samples", default="mosaic", choices=ENGINES)
+    parser.add_argument("--decimation", help="read the tiles at up to 1/DECIMATION of the resolution if the patches are scaled down that much (default 1: full resolution)", default=1, type=int)
+    parser.add_argument("--max-memory", help="assemble the mosaic of a tile in strips of about this many GB if it needs more, a target rather than a cap: a strip is at least as high as its overlap (default: whole mosaics)", default=None, type=float)
+    parser.add_argument("--min-mean-height", help="reject samples whose mean height in m is below this (e.g. sea)", default=None, type=float)
+    parser.add_argument("--min-height-std", help="reject samples whose standard deviation of the heights in m is below this (flat samples)", default=None, type=float)
+    parser.add_argument("--max-nodata", help="reject samples with a larger fraction of nodata pixels (height 0: placeholders, voids and sea)", default=None, type=float)
+    parser.add_argument("--replace-rejected", help="replace rejected samples by new random positions", action="store_true")
+    parser.add_argument("--shard", help="only process shard INDEX of COUNT (0 <= INDEX < COUNT) of the tiles, every shard writes its own labels and manifest", default=None, type=parse_shard, metavar='INDEX/COUNT')
+    parser.add_argument("--merge-shards", help="merge the labels of COUNT finished shards in the output directory into one labels file and exit", default=None, type=int, metavar='COUNT')
+    parser.add_argument("--min-spacing", help="minimum distance between the centres of two samples of a tile in km", default=None, type=float)
+    
+    # Read arguments from the command line
+    args = parser.parse_args()
+    
+    input_dir = args.input_dir
+    edge_length = args.edge_length
+    amount_samples = args.amount_samples
+    
+    output_dir = args.output
+    output_size = args.size
+    DEBUG = args.debug
+    
+    cache_size = int(args.cache_size * 1024**3)
+    max_memory = int(args.max_memory * 1024**3) if args.max_memory is not None else None
+    
+    if args.cache_dir is not None: set_tile_cache(TileCache(args.cache_dir, cache_size))
+    
+    if args.output_format == 'npy' and output_size is None and args.scales is None: parser.error("--output-format npy requires --size")
+    if args.output_format == 'npy' and args.scales is not None and any(scale.output_size is None for scale in args.scales): parser.error("--output-format npy requires a size for every scale")
+    if args.scales is not None and args.total_samples is not None: parser.error("--scales sets the samples per tile of every scale and can not be combined with --total-samples")
+    if args.codec == 'webp' and args.bit_depth == 16: parser.error("--codec webp only supports 8 bit samples")
+    
+    if args.merge_shards is not None:
+        merge_sharded_labels(output_dir, args.merge_shards, args.labels_format, args.scales)
+        sys.exit(0)
+    
+    region = get_region(args.bbox, args.polygon)
+    
+    patch_filter = get_patch_filter(args.min_mean_height, args.min_height_std, args.max_nodata, args.replace_rejected)
+    try: check_engine(args.engine, patch_filter)
+    except ValueError as error: parser.error(str(error))
+    
+    #Without a writable dataset the catalog is kept in the cache or output directory
+    catalog = get_catalog(input_dir, args.catalog, args.rescan, needs_tile_stats(args.engine, max_memory), region, args.cache_dir or output_dir)
+    
+    run_sampler(input_dir, output_size, output_dir, amount_samples, edge_length, workers=args.workers, seed=args.seed, cache_dir=args.cache_dir, cache_size=cache_size, labels_format=args.labels_format, output_format=args.output_format, shard_size=args.shard_size, min_spacing=args.min_spacing, restart=args.restart, catalog=catalog, bit_depth=args.bit_depth, metrics_path=args.metrics, profile_stages=args.profile, profile_dir=args.profile_dir, prefetch=args.prefetch, codec=args.codec, compress_level=args.compress_level, encode_threads=args.encode_threads, region=region, total_samples=args.total_samples, scales=args.scales, patch_filter=patch_filter, engine=args.engine, shard=args.shard, decimation=args.decimation, max_memory=max_memory)
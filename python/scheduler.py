@@ -0,0 +1,115 @@
+import multiprocessing
+import queue
+import threading
+
+#Grid of 1° tiles is embedded into a 512x512 hilbert curve (covers 360x180)
+HILBERT_ORDER = 512
+
+def hilbert_index(x, y, order=HILBERT_ORDER):
+    #Distance of cell (x,y) along the hilbert curve filling an order x order grid
+    index = 0
+    s = order // 2
+    while s > 0:
+        rx = 1 if (x & s) > 0 else 0
+        ry = 1 if (y & s) > 0 else 0
+        index += s * s * ((3 * rx) ^ ry)
+
+        #Rotate quadrant
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s //= 2
+
+    return index
+
+def get_tile_index(tile):
+    latitude, longitude = tile
+    return hilbert_index(int(longitude) + 180, int(latitude) + 90)
+
+def sort_tiles(tiles):
+    #Neighbouring tiles end up close to each other in the processing order
+    return sorted(tiles, key=get_tile_index)
+
+def parse_shard(text):
+    #INDEX/COUNT with 0 <= INDEX < COUNT, e.g. 3/16
+    index, count = [int(value) for value in text.split('/')]
+    if count < 1 or not 0 <= index < count: raise ValueError("Invalid shard: {}".format(text))
+
+    return index, count
+
+def select_shard(tiles, shard=None):
+    #Contiguous range of the (hilbert ordered) tiles, the tiles of all shards concatenated are the original order
+    tiles = list(tiles)
+    if shard is None: return tiles
+
+    index, count = shard
+    return tiles[index * len(tiles) // count:(index + 1) * len(tiles) // count]
+
+def get_shard_suffix(shard=None):
+    #Suffix of the files which every shard writes for itself (labels, manifest, sample shards)
+    if shard is None: return ''
+    return '-{}-of-{}'.format(*shard)
+
+def get_chunksize(count, workers, chunksize=8):
+    #Large enough to keep neighbouring tiles together, small enough to use all workers
+    return max(1, min(chunksize, count // workers))
+
+def get_chunks(tiles, workers, chunksize=8):
+    tiles = list(tiles)
+    chunksize = get_chunksize(len(tiles), workers, chunksize)
+    return [tiles[start:start + chunksize] for start in range(0, len(tiles), chunksize)]
+
+def run_tiles(function, tiles, workers=1, chunksize=8, initializer=None, initargs=()):
+    #Results are yielded in the order of tiles, no matter how many workers are used
+    if workers <= 1:
+        for tile in tiles:
+            yield function(tile)
+        return
+
+    #Consecutive tiles are handed to the same worker in chunks to keep caches warm
+    tiles = list(tiles)
+    chunksize = get_chunksize(len(tiles), workers, chunksize)
+    
+    pool = multiprocessing.Pool(workers, initializer=initializer, initargs=initargs)
+    try:
+        for result in pool.imap(function, tiles, chunksize=chunksize):
+            yield result
+
+        #Let the workers exit normally so their finalizers (e.g. closing shards) run
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+def prefetch_iterator(iterable, size):
+    #Consumes iterable in a background thread, at most size items are buffered
+    items = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set(): return
+                items.put((item, None))
+            items.put((done, None))
+        except BaseException as error:
+            items.put((done, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None: raise error
+            if item is done: return
+            yield item
+    finally:
+        #Unblock the producer if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            try: items.get(timeout=0.1)
+            except queue.Empty: pass
@@ -0,0 +1,231 @@
+import math
+import os
+
+import numpy as np
+import rasterio
+from scipy import ndimage
+
+from catalog import get_tile_stats, get_edge_range, get_corner_aspect
+from metrics import stage, count
+from utilities import get_file_paths, get_default_transform
+import image_loader
+from image_loader import get_mosaic_layout, get_placeholders, get_neighbourhood_crops, decimate_transform, normalize_image, read_source, tile_exists
+
+#Radius of the sphere of EPSG:3857
+MERCATOR_RADIUS = 6378137.0
+
+def mercator_to_lon_lat(x, y):
+    #Inverse of the spherical Web Mercator projection, longitudes are wrapped to -180..180
+    lon = np.degrees(x / MERCATOR_RADIUS)
+    lat = np.degrees(np.arctan(np.sinh(y / MERCATOR_RADIUS)))
+
+    return (lon + 180) % 360 - 180, lat
+
+def get_tile_entry(path):
+    #Catalog entry of a tile with statistics, read from the tile if the catalog has none (kept in the catalog in memory)
+    entry = image_loader.tile_catalog.get_entry(path) if image_loader.tile_catalog is not None else None
+    if entry is not None and entry['nodata_fraction'] is not None: return entry
+
+    stats = get_tile_stats(path)
+    if entry is not None: entry.update(stats)
+
+    return stats
+
+def get_tile_range(entry):
+    #Height range of a whole tile, nodata pixels are 0 like in the reprojected mosaic
+    heights = [entry['min_height'], entry['max_height']] if entry['min_height'] is not None else []
+    if entry['nodata_fraction'] > 0: heights.append(0.0)
+
+    return min(heights), max(heights)
+
+def get_crop_range(entry, latitude, longitude, tile_pos, rows, cols, decimation=1):
+    #Height range of the crop of a neighbour from the edge profiles of the catalog: the band along the edge or the
+    #corner it is in (rounded up to the steps of the profile), the whole tile if the crop is deeper
+    #than the profile. None for an empty crop.
+    transform, width, height = get_default_transform(latitude, longitude)
+    transform, width, height = decimate_transform(transform, width, height, decimation)
+
+    #Same semantics as slicing the reprojected tile
+    row_start, row_stop, _ = slice(*rows).indices(height)
+    col_start, col_stop, _ = slice(*cols).indices(width)
+    if row_start >= row_stop or col_start >= col_stop: return None
+
+    west, north = mercator_to_lon_lat(*(transform * (col_start, row_start)))
+    east, south = mercator_to_lon_lat(*(transform * (col_stop, row_stop)))
+
+    #Edges the crop touches and its depth in degrees (the fraction of the tile) from them
+    sides, depths = [], []
+    if tile_pos[1] == 0: sides, depths = sides + ['bottom'], depths + [north - latitude]
+    if tile_pos[1] == 2: sides, depths = sides + ['top'], depths + [latitude + 1 - south]
+    if tile_pos[0] == 0: sides, depths = sides + ['right'], depths + [1 - (west - longitude) % 360]
+    if tile_pos[0] == 2: sides, depths = sides + ['left'], depths + [(east - longitude) % 360]
+
+    #A corner crop is within both bands and within the corner square and the wide corner deep enough for both its
+    #rows and its columns, the tightest bound of them is used
+    ranges = [get_edge_range(entry, side, depth) for side, depth in zip(sides, depths)]
+    if len(sides) == 2:
+        aspect = get_corner_aspect(latitude + 1 if sides[0] == 'top' else latitude)
+        ranges.append(get_edge_range(entry, '_'.join(sides), max(depths)))
+        ranges.append(get_edge_range(entry, '_'.join(sides) + '_wide', max(depths[0], depths[1] / aspect)))
+    ranges = [tile_range for tile_range in ranges if tile_range is not None]
+    if not ranges: return get_tile_range(entry)
+
+    return max(low for low, _ in ranges), min(high for _, high in ranges)
+
+def get_neighbourhood_heights(path_to_dataset, latitude, longitude, offset=0, decimation=1):
+    #Height range of the mosaic of get_image (offset in pixels of the full resolution) without assembling it or
+    #reading a raster: the centre tile from the catalog statistics, the parts of the other 3x3 tiles in the margin
+    #from their edge profiles. Placeholders and nodata pixels are 0, like in the reprojected mosaic.
+    heights = []
+    for path, position, tile_pos, rows, cols in get_neighbourhood_crops(path_to_dataset, latitude, longitude, offset, decimation):
+        if not tile_exists(path):
+            heights.append(0.0)
+            continue
+
+        entry = get_tile_entry(path)
+
+        if tile_pos == (1, 1): heights += get_tile_range(entry)
+        else:
+            crop_range = get_crop_range(entry, position[0], position[1], tile_pos, rows, cols, decimation)
+            if crop_range is not None: heights += crop_range
+
+    return min(heights), max(heights)
+
+class SourceMosaic:
+    #Stands in for the mosaic of get_image without reprojecting anything: the same pixel grid (the Web Mercator grid
+    #of the tile plus the margin) is mapped to WGS84 on demand and only the source pixels under it are read.
+    #With a decimation factor the windows are read at 1/decimation of the resolution.
+
+    def __init__(self, path_to_dataset, latitude, longitude, margin, shape, min_height, max_height, bit_depth=8, decimation=1):
+        self.path_to_dataset = path_to_dataset
+        self.decimation = decimation
+        self.margin = margin
+        self.shape = shape
+        self.min_height = min_height
+        self.max_height = max_height
+        self.bit_depth = bit_depth
+
+        self.transform = get_default_transform(latitude, longitude)[0]
+
+        #Open datasets by path, closed after every pass over the samples
+        self.datasets = {}
+
+    def get_dataset(self, path):
+        if path not in self.datasets: self.datasets[path] = rasterio.open(path)
+        return self.datasets[path]
+
+    def close(self):
+        for dataset in self.datasets.values(): dataset.close()
+        self.datasets = {}
+
+    def to_lon_lat(self, x, y):
+        #Continuous mosaic coordinates (pixel corners at integers) to WGS84
+        mercator_x, mercator_y = self.transform * (x - self.margin, y - self.margin)
+        return mercator_to_lon_lat(mercator_x, mercator_y)
+
+    def read(self, path, lon, lat, order=1):
+        #Heights at the coordinates inside one tile, only the window around them is read
+        src = self.get_dataset(path)
+
+        cols, rows = ~src.transform * (lon, lat)
+        cols, rows = cols - 0.5, rows - 0.5
+
+        row_start = max(int(math.floor(rows.min())) - 1, 0)
+        col_start = max(int(math.floor(cols.min())) - 1, 0)
+        row_stop = min(int(math.ceil(rows.max())) + 2, src.height)
+        col_stop = min(int(math.ceil(cols.max())) + 2, src.width)
+
+        window = rasterio.windows.Window(col_start, row_start, max(col_stop - col_start, 1), max(row_stop - row_start, 1))
+        data, transform = read_source(src, window, self.decimation)
+        data = data.astype(np.float32)
+        if src.nodata is not None: data[data == src.nodata] = 0
+
+        count('windows_read')
+        count('bytes_read', data.size * np.dtype(src.dtypes[0]).itemsize)
+
+        cols, rows = ~transform * (lon, lat)
+
+        return ndimage.map_coordinates(data, (rows - 0.5, cols - 0.5), order=order, mode='nearest', output=np.float32)
+
+    def sample(self, x, y, order=1):
+        #Heights at continuous mosaic coordinates, the coordinates can span several tiles
+        with stage('reprojection'):
+            lon, lat = self.to_lon_lat(np.ravel(x), np.ravel(y))
+
+            #Index of the 1x1 degree tile of every coordinate
+            tile_lats = np.floor(lat).astype(np.int64)
+            tile_lons = np.minimum(np.floor(lon), 179).astype(np.int64)
+            keys = (tile_lats + 90) * 360 + tile_lons + 180
+
+            heights = np.zeros(len(lon), np.float32)
+            for key in np.unique(keys):
+                tile_lat, tile_lon = int(key // 360) - 90, int(key % 360) - 180
+
+                file_name, folder_name = get_file_paths(tile_lat, tile_lon)
+                path = os.path.join(self.path_to_dataset, folder_name, file_name)
+
+                #Placeholders stay zero
+                if not tile_exists(path): continue
+
+                mask = keys == key
+                heights[mask] = self.read(path, lon[mask], lat[mask], order)
+
+        return heights.reshape(np.shape(x))
+
+def get_source_image(path_to_dataset, latitude, longitude, offset=0, bit_depth=8, decimation=1):
+    #Same interface as get_image, but the mosaic is a SourceMosaic which is only read where samples are extracted
+    file_name, folder_name = get_file_paths(latitude, longitude)
+    if not tile_exists(os.path.join(path_to_dataset, folder_name, file_name)): return None
+
+    (top_margin, image_height, bottom_margin), width = get_mosaic_layout(latitude, longitude, offset)
+    shape = (top_margin + image_height + bottom_margin, width)
+
+    min_height, max_height = get_neighbourhood_heights(path_to_dataset, latitude, longitude, offset, decimation)
+
+    image = SourceMosaic(path_to_dataset, latitude, longitude, offset, shape, min_height, max_height, bit_depth, decimation)
+
+    return image, min_height, max_height, get_placeholders(path_to_dataset, latitude, longitude)
+
+class SourceExtractor:
+    #PatchExtractor for a SourceMosaic: the rotated sampling grid of every patch is mapped to the source tiles.
+    #Antialiasing: patches which are scaled down by 2x or more are supersampled and averaged
+    #(less so if the source is read at reduced resolution, which is averaged already).
+
+    def __init__(self, image, edge_length_pixel, output_size=None, order=1):
+        self.image = image
+        self.edge_length_pixel = edge_length_pixel
+        self.output_size = output_size if output_size is not None else int(edge_length_pixel)
+        self.order = order
+
+        scale = float(self.edge_length_pixel) / self.output_size
+        self.factor = max(int(scale) // image.decimation, 1)
+
+        #Offsets of the supersampled pixel centres from the patch centre (not rotated)
+        size = self.output_size * self.factor
+        steps = (np.arange(size, dtype=np.float64) + 0.5) * scale / self.factor - self.edge_length_pixel / 2.0
+        self.offset_y, self.offset_x = np.meshgrid(steps, steps, indexing='ij')
+
+    def get_grid(self, center, angle):
+        #Angles are in degrees counter-clockwise (same as PatchExtractor)
+        radians = -math.radians(angle)
+        cos, sin = math.cos(radians), math.sin(radians)
+
+        x = center[0] + cos * self.offset_x + sin * self.offset_y
+        y = center[1] - sin * self.offset_x + cos * self.offset_y
+
+        return x, y
+
+    def extract(self, center, angle):
+        patch = self.image.sample(*self.get_grid(center, angle), order=self.order)
+
+        if self.factor > 1: patch = patch.reshape(self.output_size, self.factor, self.output_size, self.factor).mean(axis=(1, 3), dtype=np.float32)
+
+        return normalize_image(patch, self.image.min_height, self.image.max_height, self.image.bit_depth)
+
+    def iter_patches(self, centers, angles):
+        #One patch at a time, the sampling grid of a patch is as large as the patch in source pixels
+        try:
+            for center, angle in zip(centers, angles):
+                yield self.extract(center, angle)
+        finally:
+            self.image.close()
@@ -0,0 +1,139 @@
+import math
+import os
+
+import numpy as np
+
+from metrics import stage, count
+from utilities import get_file_paths
+from image_loader import get_image_rows, get_mosaic_layout, get_placeholders, normalize_image, tile_exists, NODATA_HEIGHT
+from patch_extractor import PatchExtractor, BATCH_SIZE
+from source_sampler import get_neighbourhood_heights
+
+#Memory per pixel of a mosaic: the float32 mosaic plus the rows and temporary arrays it is assembled from
+MOSAIC_BYTES_PER_PIXEL = 8
+
+def get_mosaic_bytes(latitude, longitude, offset=0, decimation=1):
+    #Memory of get_image for the neighbourhood of a tile (offset in pixels of the full resolution)
+    (top_margin, image_height, bottom_margin), width = get_mosaic_layout(latitude, longitude, offset // decimation, decimation)
+    return (top_margin + image_height + bottom_margin) * width * MOSAIC_BYTES_PER_PIXEL
+
+#Set once the strips of a patch have exceeded --max-memory (a target, not a cap)
+memory_warned = False
+
+def warn_memory(strip_bytes):
+    #Printed once per process
+    global memory_warned
+    if memory_warned: return
+
+    memory_warned = True
+    print('--max-memory is below the strips of one patch, strips of {:.3f} GB are assembled instead'.format(strip_bytes / 1024.0**3))
+
+class StripMosaic:
+    #Stands in for the mosaic of get_image if it does not fit into max_bytes: horizontal strips of the same mosaic
+    #are assembled on demand, at most max_bytes at a time. The height range is computed without the mosaic
+    #(get_neighbourhood_heights, like SourceMosaic), the whole mosaic is never held in memory.
+
+    def __init__(self, path_to_dataset, latitude, longitude, offset, shape, min_height, max_height, bit_depth=8, decimation=1, max_bytes=None):
+        self.path_to_dataset = path_to_dataset
+        self.latitude = latitude
+        self.longitude = longitude
+        self.offset = offset
+        self.shape = shape
+        self.min_height = min_height
+        self.max_height = max_height
+        self.bit_depth = bit_depth
+        self.decimation = decimation
+
+        self.max_rows = max(int(max_bytes // (shape[1] * MOSAIC_BYTES_PER_PIXEL)), 1)
+
+    def get_rows(self, start, stop, nodata_mask=False):
+        #Normalized rows start:stop, identical to the same rows of get_image with the same height range
+        with stage('mosaic'):
+            rows = get_image_rows(self.path_to_dataset, self.latitude, self.longitude, self.offset, start, stop, self.decimation)
+            count('strips_assembled')
+
+        mask = rows == NODATA_HEIGHT if nodata_mask else None
+        normalize_image(rows, self.min_height, self.max_height, self.bit_depth)
+
+        if nodata_mask: return rows, mask
+        return rows
+
+    def get_strip_height(self, overlap=0, multiple=1):
+        #Rows of a strip without the overlap above and below it, a multiple of multiple and at least the overlap:
+        #thinner strips would mostly consist of overlap, so a strip can need more than max_bytes
+        return max((self.max_rows - 2 * overlap) // multiple * multiple, overlap, multiple)
+
+    def iter_strips(self, multiple=1):
+        #(start row, rows, nodata mask of the rows) of consecutive strips without overlap
+        height = self.get_strip_height(0, multiple)
+        for start in range(0, self.shape[0], height):
+            rows, mask = self.get_rows(start, min(start + height, self.shape[0]), nodata_mask=True)
+            yield start, rows, mask
+
+def get_strip_image(path_to_dataset, latitude, longitude, offset=0, bit_depth=8, decimation=1, max_bytes=None):
+    #Same interface as get_image, but the mosaic is a StripMosaic which is assembled strip by strip
+    file_name, folder_name = get_file_paths(latitude, longitude)
+    if not tile_exists(os.path.join(path_to_dataset, folder_name, file_name)): return None
+
+    (top_margin, image_height, bottom_margin), width = get_mosaic_layout(latitude, longitude, offset // decimation, decimation)
+    shape = (top_margin + image_height + bottom_margin, width)
+
+    min_height, max_height = get_neighbourhood_heights(path_to_dataset, latitude, longitude, offset, decimation)
+
+    image = StripMosaic(path_to_dataset, latitude, longitude, offset, shape, min_height, max_height, bit_depth, decimation, max_bytes)
+
+    return image, min_height, max_height, get_placeholders(path_to_dataset, latitude, longitude)
+
+class StripExtractor:
+    #PatchExtractor for a StripMosaic: every sample belongs to the strip of its centre, the strips overlap by the radius
+    #of a rotated patch, so a patch is the same as the one cut from the whole mosaic.
+    #The samples have to be sorted by strip (get_strip_order), every strip is assembled once.
+
+    def __init__(self, image, edge_length_pixel, output_size=None, order=1):
+        self.image = image
+        self.edge_length_pixel = edge_length_pixel
+        self.output_size = output_size if output_size is not None else int(edge_length_pixel)
+        self.order = order
+
+        #Strips start on the blocks of the antialiasing of PatchExtractor
+        self.factor = max(int(float(self.edge_length_pixel) / self.output_size), 1)
+
+        #Half the diagonal of a patch plus the interpolation and a block on both sides
+        overlap = int(math.ceil(edge_length_pixel * math.sqrt(2) / 2)) + 2 * self.factor + 2
+        self.overlap = -(-overlap // self.factor) * self.factor
+
+        self.strip_height = image.get_strip_height(self.overlap, self.factor)
+        self.strips = -(-image.shape[0] // self.strip_height)
+
+        strip_rows = self.strip_height + 2 * self.overlap
+        if strip_rows > image.max_rows: warn_memory(strip_rows * image.shape[1] * MOSAIC_BYTES_PER_PIXEL)
+
+    def get_strips(self, centers):
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        return np.clip(np.floor(centers[:, 1] / self.strip_height), 0, self.strips - 1).astype(np.intp)
+
+    def iter_patches(self, centers, angles, batch_size=BATCH_SIZE):
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        strips = self.get_strips(centers)
+
+        #Runs of samples in the same strip
+        starts = np.flatnonzero(np.diff(strips, prepend=-1))
+        stops = np.append(starts[1:], len(strips))
+
+        for start, stop in zip(starts, stops):
+            strip = strips[start]
+
+            row_start = max(strip * self.strip_height - self.overlap, 0)
+            row_stop = min((strip + 1) * self.strip_height + self.overlap, self.image.shape[0])
+
+            extractor = PatchExtractor(self.image.get_rows(row_start, row_stop), self.edge_length_pixel, self.output_size, self.order)
+
+            for patch in extractor.iter_patches(centers[start:stop] - np.array([0, row_start]), angles[start:stop], batch_size):
+                yield patch
+
+            #The strip is freed before the next one is assembled
+            del extractor
+
+def get_strip_order(image, centers, edge_length_pixel, output_size=None):
+    #Order of the samples by strip (stable, samples of a strip keep their order)
+    return np.argsort(StripExtractor(image, edge_length_pixel, output_size).get_strips(centers), kind='stable')
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+import rasterio
+
+import sampler
+from patch_filter import get_patch_filter
+from utilities import get_file_paths
+
+def test_zero_budget_tiles_are_not_read(tmp_path, monkeypatch, capsys):
+    #The tiles only have to exist for the catalog, none of them may be opened
+    input_dir = tmp_path / 'input'
+    for latitude in range(46, 49):
+        for longitude in range(9, 12):
+            file_name, folder_name = get_file_paths(latitude, longitude)
+            os.makedirs(str(input_dir / folder_name), exist_ok=True)
+            (input_dir / folder_name / file_name).write_bytes(b'')
+
+    def open_raster(*args, **kwargs):
+        raise AssertionError('raster opened: {}'.format(args[0]))
+
+    monkeypatch.setattr(rasterio, 'open', open_raster)
+
+    output_dir = tmp_path / 'output'
+    sampler.run_sampler(str(input_dir), 64, str(output_dir), 10, 10, total_samples=0)
+
+    assert '0 of 0 tiles already done' in capsys.readouterr().out
+
+def test_direct_engine_rejects_patch_filter(tmp_path):
+    with pytest.raises(ValueError):
+        sampler.run_sampler(str(tmp_path), 64, str(tmp_path / 'output'), 10, 10, patch_filter=get_patch_filter(max_nodata=0.5), engine='direct')
+
+    with pytest.raises(ValueError):
+        next(sampler.iter_samples(str(tmp_path), 10, 10, patch_filter=get_patch_filter(max_nodata=0.5), engine='direct'))
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from metrics import count
+
+DEFAULT_MAX_BYTES = 8 * 1024**3
+
+class TileCache:
+    #Content-addressed on-disk cache of reprojected tiles.
+    #Each entry is a float32 .npy file which is memory-mapped on access.
+    #The file modification time is used as LRU timestamp.
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, path, target_crs, resampling):
+        mtime = os.stat(path).st_mtime_ns
+        key = "{}|{}|{}|{}".format(os.path.abspath(path), mtime, target_crs, resampling)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key):
+        entry_path = self.get_entry_path(key)
+
+        try:
+            array = np.load(entry_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+
+        count('cache_hits')
+
+        #Mark as recently used
+        try: os.utime(entry_path)
+        except FileNotFoundError: pass
+
+        return array
+
+    def store(self, key, array):
+        array = np.asarray(array, dtype=np.float32)
+
+        if array.nbytes > self.max_bytes: return
+
+        self.evict(self.max_bytes - array.nbytes)
+
+        #Write to a temporary file first so concurrent readers never see partial entries
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                np.save(file, array)
+            os.replace(tmp_path, self.get_entry_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    def get(self, path, target_crs, resampling):
+        return self.load(self.get_key(path, target_crs, resampling))
+
+    def get_or_create(self, path, target_crs, resampling, create):
+        key = self.get_key(path, target_crs, resampling)
+
+        array = self.load(key)
+        if array is not None: return array
+
+        array = create()
+        self.store(key, array)
+        return array
+
+    def get_entries(self):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if not file.endswith('.npy'): continue
+            entry_path = os.path.join(self.cache_dir, file)
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        return entries
+
+    def get_size(self):
+        return sum(size for _, size, _ in self.get_entries())
+
+    def evict(self, target_bytes):
+        entries = self.get_entries()
+        total_bytes = sum(size for _, size, _ in entries)
+
+        #Least recently used first
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= target_bytes: break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        self.evict(0)
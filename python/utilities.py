@@ -3,12 +3,15 @@ import numpy as np
 from rasterio.warp import calculate_default_transform, transform_bounds
 from math import sin, cos, sqrt, atan2, radians
 import geopy.distance
+from functools import lru_cache
 
 IMAGE_HEIGHT = 3600
 
 INPUT_PROJECTION = 'EPSG:4326' # (WGS 84)
 OUTPUT_PROJECTION = 'EPSG:3857' # (Web Mercator)
 
+EARTH_RADIUS = 6371.0088 # km
+
 def get_pixel_width(latitude):
     #Specs from https://www.eorc.jaxa.jp/ALOS/en/aw3d30/aw3d30v3.2_product_e_e1.2.pdf
     if latitude >= 80 or latitude <= -80:
@@ -61,6 +64,10 @@ def string_to_position(str):
     
     return lat, lon
     
+def get_tile_area(latitude):
+    #Ground area of a 1x1 degree tile in km² (sphere with the mean earth radius)
+    return EARTH_RADIUS**2 * radians(1) * abs(sin(radians(latitude + 1)) - sin(radians(latitude)))
+    
 def get_file_paths(latitude,longitude):
 
     lat_str = stringify_latitude(latitude)
@@ -95,15 +102,44 @@ def get_file_paths(latitude,longitude):
     return file_name, folder_name
     
 def get_bounds(latitude, longitude):
-    right_longitude = (((longitude+180)+1)%360)-180
-    return (longitude, latitude, right_longitude, latitude+1)
-
-def pixel_to_coordinates(latitude,longitude, points):
+    #No wrap around at the antimeridian, the bounds of E179 end at 180
+    return (longitude, latitude, longitude+1, latitude+1)
 
+@lru_cache(maxsize=None)
+def get_default_transform(latitude, longitude):
+    
     bounds = get_bounds(latitude,longitude)
     
-    transform, width, height = calculate_default_transform(
-        INPUT_PROJECTION, OUTPUT_PROJECTION, get_pixel_width(latitude), 3600, *bounds)
+    return calculate_default_transform(
+        INPUT_PROJECTION, OUTPUT_PROJECTION, get_pixel_width(latitude), IMAGE_HEIGHT, *bounds)
+        
+#Everything which only depends on the latitude band: latitude -> (width, height, lat_distance, lon_distance)
+projection_table = {}
+
+def get_projection_band(latitude):
+    
+    if latitude not in projection_table:
+        transform, width, height = get_default_transform(latitude, 0)
+        
+        #Distances along the top edge of the tile (lon distance is the same for every longitude)
+        top_latitude = latitude + 1
+        
+        lat_distance = geopy.distance.geodesic((top_latitude,0), (latitude,0)).km
+        lon_distance = geopy.distance.geodesic((top_latitude,0), (top_latitude,1)).km
+        
+        projection_table[latitude] = (width, height, lat_distance, lon_distance)
+        
+    return projection_table[latitude]
+    
+def build_projection_table():
+    for latitude in range(-90, 90):
+        get_projection_band(latitude)
+        
+    return projection_table
+
+def pixel_to_coordinates(latitude,longitude, points):
+    
+    transform, width, height = get_default_transform(latitude, longitude)
     
     y = points[:,0]
     x = points[:,1]
@@ -116,24 +152,18 @@ def pixel_to_coordinates(latitude,longitude, points):
     
     
 def get_target_pixel_dimensions(latitude,longitude):
-
-    bounds = get_bounds(latitude,longitude)
     
-    transform, width, height = calculate_default_transform(
-        INPUT_PROJECTION, OUTPUT_PROJECTION, get_pixel_width(latitude), IMAGE_HEIGHT, *bounds)
+    width, height, _, _ = get_projection_band(latitude)
         
     return width, height
     
+@lru_cache(maxsize=None)
 def km_to_pixel(latitude,longitude, km):
-
-    bounds = get_bounds(latitude,longitude)
     
-    biggest_latitude = latitude
-    if biggest_latitude > 0:
-        biggest_latitude += 1
+    #The top edge of the tile is the origin of the transform
+    biggest_latitude = latitude + 1
     
-    lat_distance = geopy.distance.geodesic((biggest_latitude,longitude), (latitude,longitude)).km
-    lon_distance = geopy.distance.geodesic((biggest_latitude,longitude), (biggest_latitude,bounds[2])).km
+    _, _, lat_distance, lon_distance = get_projection_band(latitude)
     
     lat_radius = km/lat_distance
     lon_radius = km/lon_distance
@@ -141,12 +171,10 @@ def km_to_pixel(latitude,longitude, km):
     lats = [biggest_latitude-lat_radius]
     lons = [longitude+lon_radius]
     
-    transform, width, height = calculate_default_transform(
-    INPUT_PROJECTION, OUTPUT_PROJECTION, get_pixel_width(latitude), IMAGE_HEIGHT, *bounds)
+    transform, width, height = get_default_transform(latitude, longitude)
     
     lat_lon = rasterio.warp.transform(INPUT_PROJECTION, OUTPUT_PROJECTION, lons,  lats)
     
     pixel_positions = rasterio.transform.rowcol(transform,lat_lon[0],lat_lon[1])
     
-    
-    return int((pixel_positions[0] + pixel_positions[1])/2)
+    return int((pixel_positions[0][0] + pixel_positions[1][0])/2)